@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Synthetic WSJT-X like ADIF logs for the benchmarks.
+#
+# Callsigns are drawn from a pool with a long-tailed distribution, so a few stations
+# show up again and again like in real FT8 logs. Most grids are 4 chars long as
+# written by WSJT-X, some are 6 chars long and some are missing.
+#
+# Usage: adif_generator.py <number of records> <outputfile> [seed]
+
+import datetime
+import random
+import sys
+
+PREFIXES = ["DL", "DK", "DJ", "DM", "OE", "HB9", "F", "G", "I", "EA", "SP", "OK", "PA", "ON", "OH", "SM", "LA",
+            "K", "W", "N", "VE", "JA", "VK", "ZL", "PY", "LU", "UA", "R", "YO", "LZ"]
+MODES = [("FT8", 0.8), ("FT4", 0.15), ("JT65", 0.05)]
+BANDS = [("160m", 1.8400), ("80m", 3.5730), ("40m", 7.0740), ("30m", 10.1360), ("20m", 14.0740),
+         ("17m", 18.1000), ("15m", 21.0740), ("12m", 24.9150), ("10m", 28.0740), ("6m", 50.3130), ("2m", 144.1740)]
+
+
+def field(name, value):
+    return "<" + name + ":" + str(len(value)) + ">" + value + " "
+
+
+def make_callsign(rnd):
+    suffix = "".join(rnd.choice("ABCDEFGHIJKLMNOPRSTUVWXYZ") for _ in range(rnd.randint(1, 3)))
+    return rnd.choice(PREFIXES) + str(rnd.randint(0, 9)) + suffix
+
+
+def make_grid(rnd):
+    return rnd.choice("ABCDEFGHIJKLMNOPQR") + rnd.choice("ABCDEFGHIJKLMNOPQR") + str(rnd.randint(0, 99)).zfill(2)
+
+
+def generate_records(count, seed=1, station_callsign="DM2VV", station_grid="JO62RO"):
+    rnd = random.Random(seed)
+    # roughly one new station per four QSOs, the pool of known stations grows with the log
+    pool = [make_callsign(rnd) for _ in range(max(10, count // 4))]
+    grids = {call: make_grid(rnd) for call in pool}
+    start = datetime.datetime(2020, 1, 1)
+
+    for i in range(count):
+        # long-tailed: low indices are picked much more often
+        call = pool[min(len(pool) - 1, int(rnd.paretovariate(1.2)) - 1)] if rnd.random() < 0.5 else rnd.choice(pool)
+        grid = grids[call]
+        chance = rnd.random()
+        if chance < 0.1:
+            grid = ""
+        elif chance < 0.25:
+            grid = grid + rnd.choice("abcdefghijklmnopqrstuvwx") + rnd.choice("abcdefghijklmnopqrstuvwx")
+
+        mode = rnd.choices([m[0] for m in MODES], [m[1] for m in MODES])[0]
+        band, freq = rnd.choice(BANDS)
+        time_on = start + datetime.timedelta(seconds=i * 90 + rnd.randint(0, 30))
+        time_off = time_on + datetime.timedelta(seconds=rnd.randint(45, 120))
+
+        record = field("call", call)
+        if grid != "":
+            record += field("gridsquare", grid)
+        record += field("mode", mode)
+        record += field("rst_sent", "{0:+03d}".format(rnd.randint(-24, 10)))
+        record += field("rst_rcvd", "{0:+03d}".format(rnd.randint(-24, 10)))
+        record += field("qso_date", time_on.strftime("%Y%m%d"))
+        record += field("time_on", time_on.strftime("%H%M%S"))
+        record += field("qso_date_off", time_off.strftime("%Y%m%d"))
+        record += field("time_off", time_off.strftime("%H%M%S"))
+        record += field("band", band)
+        record += field("freq", "{0:.6f}".format(freq + rnd.randint(0, 3000) / 1000000.0))
+        record += field("station_callsign", station_callsign)
+        record += field("my_gridsquare", station_grid)
+        record += field("tx_pwr", str(rnd.choice([5, 10, 25, 50, 100])))
+        record += field("operator", station_callsign)
+        record += "<eor>"
+        yield record
+
+
+def generate_log(path, count, seed=1):
+    with open(path, "w") as file:
+        file.write("WSJT-X ADIF Export<eoh>\n")
+        for record in generate_records(count, seed):
+            file.write(record + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: " + sys.argv[0] + " <number of records> <outputfile> [seed]")
+        sys.exit(2)
+    generate_log(sys.argv[2], int(sys.argv[1]), int(sys.argv[3]) if len(sys.argv) > 3 else 1)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# Benchmark: throughput of the streaming ADIF parser in records/sec.
+#
+# Writes a synthetic WSJT-X like log and parses it with read_adif_records(),
+# reporting records/sec, MB/sec and the peak memory allocated while parsing.
+
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+
+RECORD_COUNTS = [10000, 100000, 500000]
+RECORD = ("<call:6>DL{0:04d} <gridsquare:4>JO62 <mode:3>FT8 <rst_sent:3>-17 <rst_rcvd:3>-08 "
+          "<qso_date:8>20200719 <time_on:6>191800 <qso_date_off:8>20200719 <time_off:6>191905 "
+          "<band:3>20m <freq:9>14.075500 <station_callsign:5>DM2VV <my_gridsquare:6>JO62RO "
+          "<tx_pwr:3>100 <operator:5>DM2VV <eor>\n")
+
+
+def build_log(path, count):
+    with open(path, "w") as file:
+        file.write("WSJT-X ADIF Export<eoh>\n")
+        for i in range(count):
+            file.write(RECORD.format(i % 10000))
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.WARNING)
+    print("{0:>10} {1:>14} {2:>10} {3:>14}".format("records", "records/sec", "MB/sec", "peak mem (kB)"))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for count in RECORD_COUNTS:
+            path = os.path.join(tmpdir, "log_" + str(count) + ".adi")
+            build_log(path, count)
+            size = os.path.getsize(path)
+
+            start = time.perf_counter()
+            parsed = 0
+            for _ in adi_to_qrz.read_adif_records(path):
+                parsed += 1
+            duration = time.perf_counter() - start
+
+            # a separate pass for the memory measurement, tracemalloc slows things down
+            tracemalloc.start()
+            for _ in adi_to_qrz.read_adif_records(path):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print("{0:>10} {1:>14.0f} {2:>10.1f} {3:>14.0f}".format(
+                parsed, parsed / duration, size / duration / 1000000, peak / 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Benchmark: per-record cost of writing the record cache.
+#
+# Compares opening, appending and closing record_cache.txt for every record - as
+# done before the background writer was introduced - with Uploader.add_record_to_cache(),
+# which queues the entries for the writer thread, for the text and binary caches.
+# The time includes the final flush, so every entry is on disk when it stops.
+
+import logging
+import os
+import sys
+import tempfile
+import time
+from hashlib import sha1
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+
+RECORDS = 20000
+RECORD = "<call:6>DL{0:04d} <gridsquare:4>JO62 <mode:3>FT8 <qso_date:8>20200719 <time_on:6>191800 <band:3>20m <eor>"
+
+
+def write_per_record(uploader, records):
+    path = uploader.path(adi_to_qrz.RECORD_CACHE)
+    for record in records:
+        file = open(path, "a")
+        file.write(sha1(record.encode('utf-8')).hexdigest() + ":" + record + os.linesep)
+        file.close()
+
+
+def write_async(uploader, records):
+    for record in records:
+        uploader.add_record_to_cache(record)
+    uploader.flush_writes()
+
+
+def measure(backend, write, records, cache_dir):
+    uploader = adi_to_qrz.Uploader("benchmark", cache_backend=backend, cache_dir=cache_dir)
+    uploader.load_record_cache()
+
+    start = time.perf_counter()
+    write(uploader, records)
+    duration = time.perf_counter() - start
+
+    uploader.close()
+    return duration
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.WARNING)
+    records = [RECORD.format(i) for i in range(RECORDS)]
+    print("{0} records written into the record cache".format(RECORDS))
+    print("{0:>26} {1:>12} {2:>14}".format("", "total (ms)", "per record (us)"))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i, (name, backend, write) in enumerate((("open/append/close (text)", "text", write_per_record),
+                                                    ("background writer (text)", "text", write_async),
+                                                    ("background writer (binary)", "binary", write_async))):
+            cache_dir = os.path.join(tmpdir, str(i))
+            os.mkdir(cache_dir)
+            duration = measure(backend, write, records, cache_dir)
+            print("{0:>26} {1:>12.1f} {2:>14.2f}".format(name, duration * 1000, duration / RECORDS * 1000000))
+
+
+if __name__ == "__main__":
+    main()
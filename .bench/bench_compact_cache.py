@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Benchmark: compaction of a record cache grown over years.
+#
+# The cache holds every QSO twice - hashed as raw record, as written before the QSO
+# fingerprints, and by its fingerprint - and a share of the entries again, as written
+# after "duplicate" answers. Reported are the entries, size, load time and lookup time
+# of the cache before and after Uploader.compact_record_cache().
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from hashlib import sha1
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+from adif_generator import generate_records  # noqa: E402
+
+QSOS = 50000
+DUPLICATES = 0.1
+
+
+def write_cache(path, uploader):
+    with open(path, "w") as file:
+        for i, record in enumerate(adi_to_qrz.parse_records(generate_records(QSOS))):
+            lines = [sha1(record.raw.encode('utf-8')).hexdigest() + ":" + record.raw,
+                     sha1(uploader.record_fingerprint(record).encode('utf-8')).hexdigest() + ":" + record.raw]
+            if i % int(1 / DUPLICATES) == 0:
+                lines.append(lines[-1])
+            file.write("\n".join(lines) + "\n")
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.WARNING)
+    print("{0} QSOs, {1} entries per QSO in the cache".format(QSOS, 2 + DUPLICATES))
+    print("{0:>20} {1:>10} {2:>10} {3:>10} {4:>10} {5:>12} {6:>12}".format(
+        "", "entries", "after", "size (MB)", "after", "load (ms)", "after"))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "record_cache.txt")
+        write_cache(source, adi_to_qrz.Uploader("benchmark"))
+
+        for i, (name, backend, hashes_only) in enumerate((("text", "text", False),
+                                                          ("text, hashes only", "text", True),
+                                                          ("sqlite", "sqlite", False),
+                                                          ("binary", "binary", False))):
+            cache_dir = os.path.join(tmpdir, str(i))
+            os.mkdir(cache_dir)
+            shutil.copy(source, cache_dir)
+            with adi_to_qrz.Uploader("benchmark", cache_backend=backend, cache_dir=cache_dir) as uploader:
+                # the first load migrates the text cache into the sqlite and binary backends
+                uploader.time_record_cache()
+                load_before, _ = uploader.time_record_cache()
+                result = uploader.compact_record_cache(hashes_only)
+                load_after, _ = uploader.time_record_cache()
+            print("{0:>20} {1:>10} {2:>10} {3:>10.2f} {4:>10.2f} {5:>12.1f} {6:>12.1f}".format(
+                name, result.entries_before, result.entries_after, result.size_before / 1000000,
+                result.size_after / 1000000, load_before * 1000, load_after * 1000))
+
+
+if __name__ == "__main__":
+    main()
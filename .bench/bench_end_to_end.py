@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Benchmark: end-to-end runs of adi_to_qrz.py against the local qrz.com stub.
+#
+# For every log size a synthetic log is generated and adi_to_qrz.py is run as a
+# separate process in a scratch directory, in these scenarios:
+#   upload   - first upload of the whole log, with xml-lookups
+#   rerun    - the same log again, every record is found in the record cache
+#   append   - 1% new records appended, the rest is skipped via the checkpoint
+# Reported are records/sec, wall time, peak memory (RSS) of the process and the
+# p50 latencies of the single processing phases from --stats-json.
+#
+# Usage: bench_end_to_end.py [sizes, default: 1000] [stub latency in seconds, default: 0.005] [workers, default: 8]
+# e.g.   bench_end_to_end.py 1000,100000,1000000 0.02 16
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from adif_generator import generate_log, generate_records
+from qrz_stub import start_stub_server
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "adi_to_qrz.py")
+PHASES = ["parse", "cache_lookup", "xml_lookup", "adif_rebuild", "api_post", "cache_write"]
+
+
+def run(workdir, server, extra_args):
+    env = dict(os.environ, APIKEY="benchmark", QRZ_COM_USERNAME="benchmark", QRZ_COM_PASSWORD="benchmark",
+               QRZ_API_URL=server.url + "api", QRZ_XML_URL=server.url + "xml/current/")
+    env.pop('XMLKEY', None)
+    args = [sys.executable, SCRIPT, "-i", "log.adi", "-l", "null", "--stats-json", "stats.json"] + extra_args
+
+    start = time.perf_counter()
+    process = subprocess.Popen(args, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    duration = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    with open(os.path.join(workdir, "stats.json")) as file:
+        stats = json.load(file)
+    # ru_maxrss is in kB on linux
+    return duration, usage.ru_maxrss, stats
+
+
+def report(scenario, size, duration, rss, stats):
+    processed = stats['records']['processed']
+    phases = stats['phases']
+    latencies = ["{0:>8.2f}".format(phases[phase]['p50'] * 1000) if phase in phases else "{0:>8}".format("-")
+                 for phase in PHASES]
+    print("{0:>8} {1:>9} {2:>9} {3:>10.0f} {4:>8.2f} {5:>9.0f} {6}".format(
+        scenario, size, processed, processed / duration, duration, rss / 1024, " ".join(latencies)))
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1].split(",")] if len(sys.argv) > 1 else [1000]
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.005
+    workers = sys.argv[3] if len(sys.argv) > 3 else "8"
+
+    print("stub latency {0} ms, {1} workers, p50 phase latencies in ms".format(int(latency * 1000), workers))
+    print("{0:>8} {1:>9} {2:>9} {3:>10} {4:>8} {5:>9} {6}".format(
+        "scenario", "records", "processed", "records/s", "wall (s)", "rss (MB)",
+        " ".join("{0:>8}".format(phase[:8]) for phase in PHASES)))
+
+    for size in sizes:
+        server = start_stub_server(latency)
+        workdir = tempfile.mkdtemp(prefix="adi_to_qrz_bench_")
+        try:
+            log = os.path.join(workdir, "log.adi")
+            generate_log(log, size)
+
+            args = ["-x", "--workers", workers, "--lookup-workers", workers]
+            report("upload", size, *run(workdir, server, args))
+            report("rerun", size, *run(workdir, server, args + ["--no-checkpoint"]))
+
+            with open(log, "a") as file:
+                for record in generate_records(max(1, size // 100), seed=2):
+                    file.write(record + "\n")
+            report("append", size, *run(workdir, server, args))
+        finally:
+            server.shutdown()
+            shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# Benchmark: cost of writing an enriched locator into a record.
+#
+# Compares the rebuild of the whole record used before - all fields upper-cased and
+# concatenated one by one - with set_adif_fields(), which replaces only the GRIDSQUARE
+# field in the original text, for WSJT-X records and for records with a long comment.
+# Reported are the time per record and the number of other fields whose value changed.
+
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+from adif_generator import generate_records  # noqa: E402
+
+RECORDS = 20000
+LOCATOR = "JO62ro"
+COMMENT = "<comment:{0}>{1} "
+
+
+def rebuild(record):
+    data = {}
+    for key, value in record.fields.items():
+        data[key] = value.strip().upper()
+    data['GRIDSQUARE'] = LOCATOR
+    adif = ""
+    for element in data:
+        adif += "<" + element.lower() + ":" + str(len(data[element])) + ">" + str(data[element]) + " "
+    adif += " <eor>"
+    return adif
+
+
+def splice(record):
+    return adi_to_qrz.set_adif_fields(record, {'GRIDSQUARE': LOCATOR})
+
+
+def changed_fields(record, adif):
+    fields = next(adi_to_qrz.parse_records([adif])).fields
+    return sum(1 for name, value in record.fields.items() if name != 'GRIDSQUARE' and fields.get(name) != value)
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.WARNING)
+    comment = "Tnx fer the QSO, 73 de DM2VV - Rig: IC-7300, Ant: EFHW @ 10m, " * 20
+    logs = (("wsjt-x", list(adi_to_qrz.parse_records(generate_records(RECORDS)))),
+            ("long comment", list(adi_to_qrz.parse_records(
+                record.replace("<eor>", COMMENT.format(len(comment), comment) + "<eor>")
+                for record in generate_records(RECORDS)))))
+
+    print("{0} records".format(RECORDS))
+    print("{0:>14} {1:>10} {2:>16} {3:>16}".format("records", "method", "per record (us)", "changed fields"))
+    for name, records in logs:
+        for method_name, method in (("rebuild", rebuild), ("splice", splice)):
+            start = time.perf_counter()
+            results = [method(record) for record in records]
+            duration = time.perf_counter() - start
+            changed = sum(changed_fields(record, adif) for record, adif in zip(records, results))
+            print("{0:>14} {1:>10} {2:>16.2f} {3:>16}".format(name, method_name, duration / RECORDS * 1000000, changed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Benchmark: per-record request latency with and without the shared http session.
+#
+# Compares a bare requests.post() per record - as done before the shared session
+# was introduced - with Uploader.http_post(), which reuses pooled keep-alive connections,
+# against the local qrz.com stub.
+
+import logging
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+from qrz_stub import start_stub_server  # noqa: E402
+
+REQUESTS = 500
+PAYLOAD = {'KEY': "benchmark", 'ACTION': 'INSERT', 'ADIF': "<call:6>DL0001 <band:3>20m <mode:3>FT8 <eor>"}
+
+
+def measure(post, url):
+    latencies = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        post(url, PAYLOAD)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return sum(latencies) / len(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.WARNING)
+    server = start_stub_server()
+    url = server.url + "api"
+
+    print("{0} requests against the local stub".format(REQUESTS))
+    print("{0:>22} {1:>10} {2:>10} {3:>10} {4:>12}".format("", "avg (ms)", "p50 (ms)", "p99 (ms)", "connections"))
+
+    for name, post in (("requests.post", lambda u, p: requests.post(u, data=p)),
+                       ("http_post (session)", adi_to_qrz.Uploader("benchmark").http_post)):
+        server.connections.clear()
+        avg, p50, p99 = measure(post, url)
+        print("{0:>22} {1:>10.2f} {2:>10.2f} {3:>10.2f} {4:>12}".format(
+            name, avg * 1000, p50 * 1000, p99 * 1000, len(server.connections)))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Benchmark: uploads against a throttling qrz.com.
+#
+# The local stub answers more than RATE_LIMIT requests per second with http-code 429.
+# Reported are the achieved records/sec, the number of throttled requests and
+# the rate and parallelism the adaptive rate limiter settled at. All records
+# have to be added in the end - none may be lost to the throttling.
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+from qrz_stub import start_stub_server  # noqa: E402
+
+LATENCY = 0.01
+RECORDS = 600
+RATE_LIMITS = [50, 100]
+WORKERS = 16
+RECORD = "<call:6>DL{0:04d} <gridsquare:6>JO62RO <mode:3>FT8 <qso_date:8>20200719 <time_on:6>191800 <band:3>20m <eor>"
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.ERROR)
+    records = [adi_to_qrz.AdifRecord({'CALL': "DL{0:04d}".format(i)}, RECORD.format(i), 0) for i in range(RECORDS)]
+
+    print("{0} records, {1} workers, {2} ms latency per request".format(RECORDS, WORKERS, int(LATENCY * 1000)))
+    print("{0:>11} {1:>12} {2:>10} {3:>10} {4:>12} {5:>12}".format(
+        "limit (r/s)", "records/sec", "throttled", "parked", "final rate", "final workers"))
+
+    for rate_limit in RATE_LIMITS:
+        server = start_stub_server(LATENCY, rate_limit=rate_limit)
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                adi_to_qrz.Uploader("benchmark", api_url=server.url + "api", workers=WORKERS,
+                                    cache_dir=tmpdir) as uploader:
+            start = time.perf_counter()
+            result = uploader.upload(records)
+            duration = time.perf_counter() - start
+        server.shutdown()
+
+        if result.added != RECORDS:
+            print("Only {0} of {1} records were added".format(result.added, RECORDS))
+            sys.exit(1)
+
+        limiter = uploader.rate_limiters['api']
+        print("{0:>11} {1:>12.1f} {2:>10} {3:>10} {4:>12.1f} {5:>12}".format(
+            rate_limit, RECORDS / duration, server.throttles, uploader.parked, limiter.rate, limiter.concurrency))
+
+
+if __name__ == "__main__":
+    main()
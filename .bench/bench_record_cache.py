@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Benchmark: per-record cost of the record cache lookup in relation to the cache size.
+#
+# Builds synthetic record caches with up to 1M entries and measures the time of
+# loading the cache and the average time of a single Uploader.find_cached_record() call,
+# for the text cache (in-memory hash index) and the binary cache (memory-mapped
+# sorted digests). Lookup cost is expected to stay flat or grow logarithmically
+# while the cache grows; the binary cache opens in constant time.
+
+import logging
+import os
+import sys
+import tempfile
+import time
+from hashlib import sha1
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+
+CACHE_SIZES = [1000, 10000, 100000, 1000000]
+LOOKUPS = 20000
+RECORD = "<call:6>DL{0:04d} <gridsquare:4>JO62 <mode:3>FT8 <qso_date:8>20200719 <time_on:6>191800 <band:3>20m <eor>"
+
+
+def build_cache(path, size):
+    with open(path, "w") as file:
+        for i in range(size):
+            record = RECORD.format(i)
+            file.write(sha1(record.encode('utf-8')).hexdigest() + ":" + record + os.linesep)
+
+
+def build_binary_cache(path, size):
+    digests = sorted(sha1(RECORD.format(i).encode('utf-8')).digest() for i in range(size))
+    with open(path, "wb") as file:
+        file.write(adi_to_qrz.RECORD_BIN_MAGIC)
+        file.write(b"".join(digests))
+
+
+def measure(backend, cache_dir):
+    uploader = adi_to_qrz.Uploader("benchmark", cache_backend=backend, cache_dir=cache_dir)
+
+    start = time.perf_counter()
+    uploader.load_record_cache()
+    load_time = time.perf_counter() - start
+
+    # half of the lookups are hits, half are misses
+    records = [RECORD.format(i * 2) for i in range(LOOKUPS)]
+    start = time.perf_counter()
+    for record in records:
+        uploader.find_cached_record(record)
+    lookup_time = time.perf_counter() - start
+
+    uploader.close()
+    return load_time, lookup_time
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.WARNING)
+    print("{0:>10} {1:>8} {2:>12} {3:>16} {4:>12}".format(
+        "entries", "backend", "load (ms)", "lookup (us/rec)", "file (kB)"))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in CACHE_SIZES:
+            cache_dir = os.path.join(tmpdir, str(size))
+            os.mkdir(cache_dir)
+            build_cache(os.path.join(cache_dir, adi_to_qrz.RECORD_CACHE), size)
+            build_binary_cache(os.path.join(cache_dir, adi_to_qrz.RECORD_CACHE_BIN), size)
+
+            for backend, name in (("text", adi_to_qrz.RECORD_CACHE), ("binary", adi_to_qrz.RECORD_CACHE_BIN)):
+                load_time, lookup_time = measure(backend, cache_dir)
+                path = os.path.join(cache_dir, name)
+                print("{0:>10} {1:>8} {2:>12.1f} {3:>16.2f} {4:>12.0f}".format(
+                    size, backend, load_time * 1000, lookup_time / LOOKUPS * 1000000, os.path.getsize(path) / 1024))
+
+
+if __name__ == "__main__":
+    main()
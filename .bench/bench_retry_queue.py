@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Benchmark: recovery of records which failed during a qrz.com outage.
+#
+# In the first run a share of the inserts fails with an internal error of qrz.com and
+# some records are rejected as invalid. Then qrz.com works again and the failed records
+# are uploaded once more - by feeding the failed records file of the first run back in,
+# as it had to be done by hand before, or by the next run draining the retry queue.
+# Reported are the inserts sent by the second run, the records recovered by it and
+# the records it failed with again.
+
+import glob
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+from qrz_stub import start_stub_server  # noqa: E402
+
+RECORDS = 2000
+FAIL_RATE = 0.2
+INVALID = 50
+RECORD = "<call:6>DL{0:04d} <gridsquare:6>JO62ro <mode:3>FT8 <qso_date:8>2020{1:02d}{2:02d} " \
+         "<time_on:6>{3:02d}{4:02d}00 <band:3>20m {5}<eor>\n"
+
+
+def write_inputfile(path):
+    with open(path, "w") as file:
+        file.write("WSJT-X ADIF Export<eoh>\n")
+        for i in range(RECORDS):
+            comment = "<comment:7>INVALID " if i % (RECORDS // INVALID) == 0 else ""
+            file.write(RECORD.format(i, i // 600 % 12 + 1, i // 24 % 25 + 1, i % 24, i % 60, comment))
+
+
+def recover(retry_queue):
+    server = start_stub_server(fail_rate=FAIL_RATE)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inputfile = os.path.join(tmpdir, "wsjtx_log.adi")
+        write_inputfile(inputfile)
+
+        with adi_to_qrz.Uploader("benchmark", api_url=server.url + "api", cache_dir=tmpdir,
+                                 retry_queue=retry_queue) as uploader:
+            first = uploader.upload_files({inputfile: 0})
+
+        # qrz.com is back, the retries are due right away
+        server.fail_rate = 0.0
+        inserts = server.inserts
+        with adi_to_qrz.Uploader("benchmark", api_url=server.url + "api", cache_dir=tmpdir,
+                                 retry_queue=retry_queue) as uploader:
+            if retry_queue:
+                second = uploader.upload_files({})
+            else:
+                failed_file = glob.glob(os.path.join(tmpdir, "*_failed_records.adi"))[0]
+                second = uploader.upload_files({failed_file: 0})
+    server.shutdown()
+    return len(first.failed), server.inserts - inserts, second.added, len(second.failed)
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.CRITICAL)
+    adi_to_qrz.RETRY_BACKOFF = 0.0
+    print("{0} records, {1:.0%} failing during the outage, {2} invalid".format(RECORDS, FAIL_RATE, INVALID))
+    print("{0:>22} {1:>14} {2:>14} {3:>14} {4:>14}".format(
+        "second run", "failed before", "inserts", "recovered", "failed again"))
+    for name, retry_queue in (("failed records file", False), ("retry queue", True)):
+        failed, inserts, recovered, failed_again = recover(retry_queue)
+        print("{0:>22} {1:>14} {2:>14} {3:>14} {4:>14}".format(name, failed, inserts, recovered, failed_again))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Benchmark: wall time of "python adi_to_qrz.py" on an inputfile without records.
+#
+# Most runs from cron find an empty wsjtx_log.adi, this is the time they take.
+# The interpreter startup alone is given for comparison. The qrz.com endpoints point
+# to the local stub, so any connection made on the way - e.g. a session key validation
+# with "-x" - is counted; there should be none.
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from qrz_stub import start_stub_server
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "adi_to_qrz.py")
+RUNS = 20
+
+
+def measure(command, cwd, env):
+    durations = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main():
+    server = start_stub_server()
+    env = dict(os.environ, APIKEY="benchmark", QRZ_COM_USERNAME="benchmark", QRZ_COM_PASSWORD="benchmark",
+               QRZ_API_URL=server.url + "api", QRZ_XML_URL=server.url + "xml/current/")
+
+    print("{0} runs each".format(RUNS))
+    print("{0:>28} {1:>12} {2:>10} {3:>12}".format("", "median (ms)", "min (ms)", "connections"))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        open(os.path.join(tmpdir, "empty.adi"), "w").close()
+        with open(os.path.join(tmpdir, "header.adi"), "w") as file:
+            file.write("WSJT-X ADIF Export<eoh>\n")
+
+        for name, command in (("interpreter only", [sys.executable, "-c", "pass"]),
+                              ("empty inputfile", [sys.executable, SCRIPT, "-i", "empty.adi"]),
+                              ("header only inputfile", [sys.executable, SCRIPT, "-i", "header.adi"]),
+                              ("empty inputfile, -x", [sys.executable, SCRIPT, "-x", "-i", "empty.adi"])):
+            server.connections.clear()
+            durations = measure(command, tmpdir, env)
+            print("{0:>28} {1:>12.1f} {2:>10.1f} {3:>12}".format(name, statistics.median(durations) * 1000,
+                                                                 min(durations) * 1000, len(server.connections)))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
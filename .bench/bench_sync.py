@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Benchmark: rebuilding the record cache from the qrz.com logbook.
+#
+# The local stub's logbook is filled with a synthetic log, then the record cache is
+# rebuilt with Uploader.sync() and the same log is uploaded again. Reported are the
+# number of FETCH requests, the duration of the sync and the number of inserts the
+# upload still sent to the stub - which should be none.
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+from adif_generator import generate_records  # noqa: E402
+from qrz_stub import start_stub_server  # noqa: E402
+
+QSO_COUNTS = [1000, 50000]
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.WARNING)
+    print("{0:>8} {1:>9} {2:>10} {3:>12} {4:>16}".format("qsos", "requests", "sync (s)", "cached", "inserts after"))
+
+    for count in QSO_COUNTS:
+        server = start_stub_server()
+        records = list(generate_records(count, seed=count))
+        for record in records:
+            server.insert(record)
+        inserts = server.inserts
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                adi_to_qrz.Uploader("benchmark", api_url=server.url + "api", cache_dir=tmpdir) as uploader:
+            start = time.perf_counter()
+            result = uploader.sync()
+            duration = time.perf_counter() - start
+
+            uploader.upload(records)
+        server.shutdown()
+
+        print("{0:>8} {1:>9} {2:>10.2f} {3:>12} {4:>16}".format(
+            count, server.fetches, duration, result.cached, server.inserts - inserts))
+
+
+if __name__ == "__main__":
+    main()
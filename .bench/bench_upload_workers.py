@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Benchmark: upload speed-up in relation to the number of workers.
+#
+# Uploads a batch of records to the local qrz.com stub with a fixed latency
+# per request and reports records/sec and the speed-up against a single worker.
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+from qrz_stub import start_stub_server  # noqa: E402
+
+LATENCY = 0.05
+RECORDS = 200
+WORKER_COUNTS = [1, 2, 4, 8, 16]
+RECORD = "<call:6>DL{0:04d} <gridsquare:6>JO62RO <mode:3>FT8 <qso_date:8>20200719 <time_on:6>191800 <band:3>20m <eor>"
+
+
+def make_records():
+    records = []
+    for i in range(RECORDS):
+        raw = RECORD.format(i)
+        records.append(adi_to_qrz.AdifRecord({'CALL': "DL{0:04d}".format(i)}, raw, 0))
+    return records
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.WARNING)
+    server = start_stub_server(LATENCY)
+    records = make_records()
+
+    print("{0} records, {1} ms latency per request".format(RECORDS, int(LATENCY * 1000)))
+    print("{0:>8} {1:>14} {2:>10} {3:>12}".format("workers", "records/sec", "speed-up", "connections"))
+
+    baseline = None
+    for workers in WORKER_COUNTS:
+        server.connections.clear()
+        server.logbook.clear()
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                adi_to_qrz.Uploader("benchmark", api_url=server.url + "api", workers=workers,
+                                    cache_dir=tmpdir) as uploader:
+            start = time.perf_counter()
+            result = uploader.upload(records)
+            duration = time.perf_counter() - start
+
+        if result.added != RECORDS:
+            print("Only {0} of {1} records were added".format(result.added, RECORDS))
+            sys.exit(1)
+
+        rate = RECORDS / duration
+        baseline = baseline or rate
+        print("{0:>8} {1:>14.1f} {2:>10.1f} {3:>12}".format(workers, rate, rate / baseline, len(server.connections)))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
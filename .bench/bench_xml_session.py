@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Benchmark: qrz.com xml session handling.
+#
+# startup - xml requests per run before the first callsign is looked up, with the plain
+#           key cached by older versions (validated on every run) and with a fresh key
+#           cached with its expiry (used as it is).
+# timeout - all session keys time out between two batches of lookups done by several
+#           workers in parallel; the workers should share a single new login and all
+#           records should still be enriched and added.
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import adi_to_qrz  # noqa: E402
+from qrz_stub import start_stub_server  # noqa: E402
+
+RUNS = 20
+RECORDS = 200
+LOOKUP_WORKERS = 8
+RECORD = "<call:6>DL{0:04d} <gridsquare:4>JO62 <mode:3>FT8 <qso_date:8>20200719 <time_on:6>191800 <band:3>20m <eor>"
+
+
+def make_uploader(server, cache_dir):
+    return adi_to_qrz.Uploader("benchmark", api_url=server.url + "api", xml_lookups=True, username="benchmark",
+                               password="benchmark", xml_url=server.url + "xml/current/", workers=LOOKUP_WORKERS,
+                               lookup_workers=LOOKUP_WORKERS, callsign_cache_ttl=0, cache_dir=cache_dir)
+
+
+def xml_requests(server):
+    return server.logins + server.validations + server.lookups
+
+
+def startup(server, plain):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # the first run logs in and caches the key
+        with make_uploader(server, tmpdir) as uploader:
+            key = uploader.xml_session.get_key()
+
+        requests = xml_requests(server)
+        start = time.perf_counter()
+        for i in range(RUNS):
+            if plain:
+                with open(os.path.join(tmpdir, adi_to_qrz.SESSION_KEY_CACHE), "w") as file:
+                    file.write(key)
+            with make_uploader(server, tmpdir) as uploader:
+                uploader.fetch_callsign_data("DL{0:04d}".format(i))
+        duration = time.perf_counter() - start
+    # one lookup per run is the payload
+    return (xml_requests(server) - requests) / RUNS - 1, duration / RUNS
+
+
+def timeout(server):
+    records = [RECORD.format(i) for i in range(RECORDS)]
+    with tempfile.TemporaryDirectory() as tmpdir, make_uploader(server, tmpdir) as uploader:
+        first = uploader.upload(records[:RECORDS // 2])
+        logins = server.logins
+        server.expire_sessions()
+        second = uploader.upload(records[RECORDS // 2:])
+    return server.logins - logins, first.added + second.added
+
+
+def main():
+    adi_to_qrz.LOGGER.setLevel(logging.WARNING)
+    server = start_stub_server(0.005)
+
+    print("startup, {0} runs, 5 ms latency".format(RUNS))
+    print("{0:>22} {1:>22} {2:>14}".format("cached key", "xml requests per run", "ms per run"))
+    for name, plain in (("plain, validated", True), ("fresh, with expiry", False)):
+        requests, duration = startup(server, plain)
+        print("{0:>22} {1:>22.1f} {2:>14.1f}".format(name, requests, duration * 1000))
+
+    logins, added = timeout(server)
+    print("")
+    print("timeout, {0} records, {1} lookup workers".format(RECORDS, LOOKUP_WORKERS))
+    print("{0:>22} {1:>22}".format("new logins", "records added"))
+    print("{0:>22} {1:>22}".format(logins, added))
+
+    server.shutdown()
+    if logins != 1 or added != RECORDS:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# A local stand-in for the qrz.com logbook api and xml interface, used by the benchmarks.
+#
+# /api           answers INSERT requests like logbook.qrz.com does: a QSO with a call,
+#                date, time and band seen before is answered as duplicate, records
+#                containing "FAIL" - and a configurable share of all records - fail,
+#                records containing "INVALID" are rejected as invalid.
+#                FETCH requests page through the added records (OPTION MAX and AFTERLOGID).
+# /xml/current/  answers session logins, session key validations and callsign
+#                lookups like xmldata.qrz.com does. Callsigns ending with "Q" are not found.
+#                Every login hands out a new session key; expire_sessions() lets all of
+#                them time out, as if they were too old.
+#
+# Every response is delayed by a configurable latency to imitate the round-trip to qrz.com.
+# With a rate limit, /api requests beyond that many per second are answered with http-code 429.
+#
+# Can be started standalone: qrz_stub.py [port] [latency in seconds]
+
+import html
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+XML_SESSION = "<?xml version=\"1.0\" ?>\n<QRZDatabase version=\"1.34\"><Session>{0}</Session>{1}</QRZDatabase>"
+QSO_KEY_FIELDS = ("call", "qso_date", "time_on", "band")
+
+
+class QrzStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, avoid delayed ACKs on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        time.sleep(self.server.latency)
+
+        if not self.path.startswith("/xml") and self.server.throttled():
+            self.send_response(429)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.path.startswith("/xml"):
+            body = self.server.xml(payload)
+        elif payload.get('ACTION') == "INSERT":
+            body = self.server.insert(payload.get('ADIF', ''))
+        elif payload.get('ACTION') == "FETCH":
+            body = self.server.fetch(payload.get('OPTION', ''))
+        else:
+            body = "RESULT=FAIL&REASON=unsupported action"
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class QrzStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, fail_rate=0.0, rate_limit=0):
+        super().__init__(address, QrzStubHandler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.rate_limit = rate_limit
+        self.requests = deque()
+        self.throttles = 0
+        self.lock = threading.Lock()
+        self.inserts = 0
+        self.lookups = 0
+        self.logbook = set()
+        self.records = {}
+        self.fetches = 0
+        self.connections = set()
+        self.logins = 0
+        self.validations = 0
+        self.session_keys = set()
+        self.expired_keys = set()
+
+    def throttled(self):
+        # sliding window of the /api requests accepted during the last second
+        if self.rate_limit <= 0:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            while self.requests and self.requests[0] < now - 1.0:
+                self.requests.popleft()
+            if len(self.requests) >= self.rate_limit:
+                self.throttles += 1
+                return True
+            self.requests.append(now)
+        return False
+
+    def insert(self, adif):
+        fields = {}
+        for name, value in re.findall(r'<(\w+):\d+[^>]*>([^<]*)', adif):
+            fields[name.lower()] = value.strip().upper()
+        qso = tuple(fields.get(name, "")[:4] if name == "time_on" else fields.get(name, "") for name in QSO_KEY_FIELDS)
+
+        with self.lock:
+            self.inserts += 1
+            logid = self.inserts
+            duplicate = qso in self.logbook
+            failed = "FAIL" in adif or "INVALID" in adif or (zlib.crc32(adif.encode('utf-8')) % 1000) < self.fail_rate * 1000
+            if not duplicate and not failed:
+                self.logbook.add(qso)
+                self.records[logid] = adif
+
+        if "INVALID" in adif:
+            return "RESULT=FAIL&REASON=Invalid qso_date&COUNT=0"
+        if duplicate:
+            return "STATUS=FAIL&REASON=Unable to add QSO to database: duplicate&EXTENDED="
+        if failed:
+            return "RESULT=FAIL&REASON=QRZ Internal Error: Unable to add QSO to database.&COUNT=0"
+        return "RESULT=OK&LOGID=" + str(logid) + "&COUNT=1"
+
+    def fetch(self, option):
+        options = dict(item.split(':', 1) for item in option.split(',') if ':' in item)
+        after = int(options.get('AFTERLOGID', 0))
+        with self.lock:
+            self.fetches += 1
+            logids = sorted(logid for logid in self.records if logid >= after)[:int(options.get('MAX', 250))]
+            adif = "".join("{0}<app_qrzlog_logid:{1}>{2}<eor>\n".format(
+                re.sub(r'(?i)<eor>\s*$', '', self.records[logid].strip()), len(str(logid)), logid) for logid in logids)
+        if not logids:
+            return "RESULT=FAIL&REASON=no log entries found&COUNT=0"
+        return "RESULT=OK&COUNT={0}&LOGIDS={1}&ADIF={2}".format(
+            len(logids), ",".join(str(logid) for logid in logids), html.escape(adif, quote=False))
+
+    def xml(self, payload):
+        if 'username' in payload:
+            with self.lock:
+                self.logins += 1
+                key = "stubsessionkey" + str(self.logins)
+                self.session_keys.add(key)
+            return XML_SESSION.format("<Key>" + key + "</Key><Count>0</Count><SubExp>Wed Jan 1 12:34:03 2031</SubExp>"
+                                      "<GMTime>" + time.strftime("%a %b %d %H:%M:%S %Y", time.gmtime()) + "</GMTime>", "")
+        key = payload.get('s')
+        if key in self.expired_keys:
+            return XML_SESSION.format("<Error>Session Timeout</Error>", "")
+        if key not in self.session_keys:
+            return XML_SESSION.format("<Error>Invalid session key</Error>", "")
+        if 'dxcc' in payload:
+            with self.lock:
+                self.validations += 1
+            return XML_SESSION.format("<Key>" + key + "</Key>", "<DXCC><dxcc>" + payload['dxcc'] + "</dxcc></DXCC>")
+
+        with self.lock:
+            self.lookups += 1
+        call = payload.get('callsign', '').upper()
+        if call.endswith("Q"):
+            return XML_SESSION.format("<Error>Not found: " + call + "</Error><Key>" + key + "</Key>", "")
+        # a stable, call specific 6 chars locator
+        checksum = zlib.crc32(call.encode('utf-8'))
+        grid = chr(65 + checksum % 18) + chr(65 + checksum // 18 % 18)
+        grid += str(checksum // 324 % 100).zfill(2)
+        grid += chr(97 + checksum // 32400 % 24) + chr(97 + checksum // 777600 % 24)
+        return XML_SESSION.format("<Key>" + key + "</Key>",
+                                  "<Callsign><call>" + call + "</call><grid>" + grid + "</grid><dxcc>230</dxcc>"
+                                  "<cqzone>14</cqzone><ituzone>28</ituzone><country>Germany</country></Callsign>")
+
+    def expire_sessions(self):
+        with self.lock:
+            self.expired_keys |= self.session_keys
+            self.session_keys = set()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(client_address)
+        super().process_request(request, client_address)
+
+    @property
+    def url(self):
+        return "http://" + self.server_address[0] + ":" + str(self.server_address[1]) + "/"
+
+
+def start_stub_server(latency=0.0, port=0, fail_rate=0.0, rate_limit=0):
+    server = QrzStubServer(("127.0.0.1", port), latency, fail_rate, rate_limit)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    stub = QrzStubServer(("127.0.0.1", int(sys.argv[1]) if len(sys.argv) > 1 else 8080),
+                         float(sys.argv[2]) if len(sys.argv) > 2 else 0.0)
+    print("Serving qrz.com stub on " + stub.url + "api and " + stub.url + "xml/current/")
+    stub.serve_forever()
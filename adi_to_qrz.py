@@ -8,335 +8,2273 @@
 
 from __future__ import print_function
 
+import atexit
 import datetime
 import getopt
+import glob
+import html
+import io
+import itertools
+import json
 import logging
+import mmap
 import os
+import queue
+import random
 import re
+import sqlite3
 import sys
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from hashlib import sha1
-
-import requests
-import xmltodict
+# requests, xmltodict and urllib3 are imported where they are used - most runs find
+# no new records and finish without ever talking to qrz.com
 
 PROGRAM_NAME = "adi_to_qrz"
-PROGRAM_VERSION = "0.8.3"
+PROGRAM_VERSION = "0.9.0"
 PROGRAM_URL = "https://www.vovka.de/v2b1n/adi_to_qrz/"
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
-LOGGER = logging.getLogger()
+# a logger of its own, programs using the Uploader keep their logging setup;
+# the command line adds STDOUT_HANDLER to it in main()
+LOGGER = logging.getLogger(PROGRAM_NAME)
 FORMATTER = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
 STDOUT_HANDLER = logging.StreamHandler()
 STDOUT_HANDLER.setFormatter(FORMATTER)
-LOGGER.addHandler(STDOUT_HANDLER)
 PATH = os.path.dirname(os.path.abspath(__file__))
 
-XMLKEY = "QRZ_COM_XMLKEY"
+# defaults of the Uploader settings
 XMLURL = "http://xmldata.qrz.com/xml/current/"
-XML_USERNAME = "QRZ_COM_USERNAME"
-XML_PASSWORD = "QRZ_COM_PASSWORD"
-XML_USERDATA = {}
-XML_LOOKUPS = False
-USERDATA = {}
-APIKEY = "QRZ_COM_APIKEY"
+SESSION_KEY_CACHE = ".session_key"
+# qrz.com doesn't tell how long a session key lasts, it's taken as fresh for a day
+SESSION_KEY_TTL = 86400
+# answers to a lookup which call for a new login
+SESSION_ERRORS = ("Session Timeout", "Invalid session key")
+CALLSIGN_CACHE = "callsign_cache.json"
+CALLSIGN_CACHE_TTL = 30
+CALLSIGN_CACHE_NEGATIVE_TTL = 1
+CALLSIGN_CACHE_SIZE = 10000
 APIURL = "https://logbook.qrz.com/api"
+HTTP_TIMEOUT = 30.0
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 1.0
+WORKERS = 1
+LOOKUP_WORKERS = 4
+UPLOAD_BATCH_SIZE = 1000
+# the lowest rate the rate limiters slow down to, requests per second
+MIN_RATE = 1.0
+# a response this many times slower than the average counts as throttling
+SLOW_RESPONSE_FACTOR = 4.0
+# weight of such slow responses in the average latency - the average still follows them,
+# more slowly, so a lasting slowdown of qrz.com becomes the new normal after a few rounds
+SLOW_RESPONSE_WEIGHT = 0.05
+# how often a record that couldn't be sent is retried later in the run
+PARK_RETRIES = 5
+# the run is stopped after this many connection failures in a row, qrz.com is most likely down then
+MAX_CONNECTION_FAILURES = 10
+SYNC_PAGE_SIZE = 1000
+# number of durations per processing phase the percentiles of the run statistics are taken from
+TIMING_SAMPLES = 10000
+RECORD_CACHE = "record_cache.txt"
+CACHE_BACKENDS = ("text", "sqlite", "binary")
+# records are identified in the record cache by their QSO ("qso") or by their raw text ("raw")
+FINGERPRINTS = ("qso", "raw")
+# fields the xml-lookups may add to a record, and the qrz.com data they are taken from
+ENRICH_FIELDS = OrderedDict([('DXCC', 'dxcc'), ('CQZ', 'cqzone'), ('ITUZ', 'ituzone'), ('COUNTRY', 'country')])
+FINGERPRINT_FIELDS = ('CALL', 'QSO_DATE', 'TIME_ON', 'BAND', 'MODE', 'STATION_CALLSIGN')
+RECORD_CACHE_DB = "record_cache.sqlite"
+RECORD_DB_BATCH_SIZE = 100
+# binary record cache: a header followed by the sorted 20 bytes sha1 digests of the records,
+# memory-mapped; new digests are appended to a journal and merged into the file on exit
+RECORD_CACHE_BIN = "record_cache.bin"
+RECORD_BIN_MAGIC = b"ADI2QRZ\x01"
+RECORD_BIN_MERGE_SIZE = 100000
+# cache entries, journal digests and failed records are appended by a background writer,
+# which writes whatever got queued in one go and fsyncs the files every WRITER_SYNC_INTERVAL seconds
+WRITER_SYNC_INTERVAL = 1.0
+CHECKPOINT_FILE = "input_checkpoints.json"
+# records failing for a transient reason are retried in later runs, with a delay doubling
+# per attempt from RETRY_BACKOFF up to RETRY_MAX_BACKOFF seconds, RETRY_ATTEMPTS times at most
+RETRY_QUEUE = "retry_queue.json"
+RETRY_BACKOFF = 300.0
+RETRY_MAX_BACKOFF = 86400.0
+RETRY_ATTEMPTS = 10
+# server reasons which won't go away by sending the record again
+PERMANENT_FAILURES = ("duplicate", "invalid", "missing", "malformed", "wrong", "not allowed", "access denied",
+                      "auth", "subscription")
+WATCH_INTERVAL = 5.0
+
+# command line settings
 LOGFILE = os.path.basename(__file__).split(".")[0] + ".log"
 INPUTFILE = "wsjtx_log.adi"
-RECORD_CACHE = "record_cache.txt"
-PROCESSED_RECORDS = 0
-CACHED_RECORDS = 0
-FAILED_RECORDS = []
-IGNORED_RECORDS = 0
-ADDED_RECORDS = 0
-DELETE_FLAG = False
-WRITE_IDLE_LOG = False
-DEBUG_FLAG = False
+ADIF_SUFFIXES = (".adi", ".adif")
+PROFILE_FILE = os.path.basename(__file__).split(".")[0] + ".prof"
+RUN_START = time.time()
 EXITCODE = 0
+ADIF_READ_SIZE = 65536
+# inputfiles are only parsed in parallel processes if none has more new data than this,
+# as the records of a file are sent back from the worker process all at once
+PARALLEL_PARSE_MAX_SIZE = 1048576
+ADIF_TAG = re.compile(rb'<(\w+)(?::(\d+)(?::[^<>]*)?)?>')
+RECORD_HASH = re.compile(r'[0-9a-f]{40}')
+
+# a parsed ADIF record:
+# fields - dict of upper-cased field names and their values
+# raw    - the original record text, as used for the record cache hashes
+# offset - byte offset in the source right after the record's "<eor>"
+# data   - the original record bytes, raw may differ from them for input not encoded in UTF-8
+AdifRecord = namedtuple('AdifRecord', ['fields', 'raw', 'offset', 'data'], defaults=(None,))
+
+# the outcome of an upload:
+# processed - number of records read
+# added     - number of records added to the logbook
+# ignored   - number of records skipped, as they were uploaded before or found twice in the input
+# failed    - the records qrz.com didn't accept or which could not be sent, as ADIF text
+UploadResult = namedtuple('UploadResult', ['processed', 'added', 'ignored', 'failed'])
+
+# the outcome of a sync from the qrz.com logbook:
+# fetched  - number of QSOs in the logbook
+# cached   - number of them added to the record cache
+# appended - number of them appended to the inputfile
+SyncResult = namedtuple('SyncResult', ['fetched', 'cached', 'appended'])
+
+# the outcome of a record cache compaction:
+# path                        - the cache file
+# entries_before/after        - number of entries
+# size_before/after           - size of the cache in bytes
+CompactResult = namedtuple('CompactResult', ['path', 'entries_before', 'entries_after', 'size_before', 'size_after'])
+
+
+class QrzError(Exception):
+    # Raised on errors talking to qrz.com, reading or writing files and on wrong settings.
+    # exitcode is the one the command line exits with: 1 - qrz.com and i/o errors,
+    # 2 - wrong settings, 3 - missing inputfiles.
+
+    def __init__(self, message: str, exitcode: int = 1):
+        super().__init__(message)
+        self.exitcode = exitcode
+
+
+def io_error(message: str, e) -> QrzError:
+    return QrzError("{0} - I/O error({1}): {2}".format(message, e.errno, e.strerror))
 
 
-# Getting/Refreshing XML session-key
-def get_xml_session_key():
-    global XMLURL, XMLKEY, XML_USERNAME, XML_PASSWORD
+def strip_quotes(value):
+    if value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+    return value
 
-    session_key_cache = ".session_key"
 
-    # either set the provided key
-    if 'XMLKEY' in os.environ:
-        XMLKEY = os.environ['XMLKEY']
-        return
+def percentile(values: list, p: float) -> float:
+    # values have to be sorted
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
 
-    # try to read the cached key
-    try:
-        with open(session_key_cache) as file:
-            XMLKEY = file.read()
-            XMLKEY = XMLKEY.strip()
-            LOGGER.debug("Session file exists, cached session key %s", str(XMLKEY))
 
-            # validate by doing a dxcc fetch for entity 291 (USA)
-            LOGGER.debug("Validating session key")
+def fetch_locator(userdata: dict) -> str:
+    if 'grid' in userdata:
+        return userdata['grid']
+    else:
+        return ""
 
-            payload = {'s': XMLKEY, 'dxcc': "291"}
 
-            try:
-                response = requests.post(XMLURL, data=payload)
-            except Exception:
-                LOGGER.error("Could not connect to %s", XMLURL)
-                exit(1)
-            else:
-                if response.status_code == 200:
-                    doc = xmltodict.parse(response.text)
-
-                    if 'Error' in doc['QRZDatabase']['Session']:
-                        if doc['QRZDatabase']['Session']['Error'] == "Session Timeout":
-                            LOGGER.info("Session  is expired")
-                        elif doc['QRZDatabase']['Session']['Error'] == "Invalid session key":
-                            LOGGER.info("Session key is no more valid")
-                        else:
-                            LOGGER.error(
-                                "An error occured when validating session key: %s", doc['QRZDatabase']['Session'][
-                                    'Error'])
+def is_permanent_failure(reason: str) -> bool:
+    reason = reason.lower()
+    return any(word in reason for word in PERMANENT_FAILURES)
 
-                        XMLKEY = ""
-                    else:
-                        LOGGER.debug("Session key is valid")
 
+def needs_enrichment(record: AdifRecord) -> bool:
+    return len(record.fields.get('GRIDSQUARE', '').strip()) <= 4 and record.fields.get('CALL', '').strip() != ""
 
-    except IOError:
-        LOGGER.debug("Session file does not exist")
-        XMLKEY = ""
 
-    # if still empty - then it has to be retrieved & saved
-    if XMLKEY == "":
-        LOGGER.debug("Getting a new session key")
+def iter_adif_fields(data: bytes):
+    # yields the tags of the fields in an ADIF text, their values are skipped by their length
+    tag = ADIF_TAG.search(data)
+    while tag is not None:
+        if tag.group(2) is None:
+            tag = ADIF_TAG.search(data, tag.end())
+        else:
+            yield tag
+            tag = ADIF_TAG.search(data, tag.end() + int(tag.group(2)))
 
-        payload = {'username': XML_USERNAME, 'password': XML_PASSWORD, 'agent': PROGRAM_NAME + "/" + PROGRAM_VERSION}
 
-        try:
-            response = requests.post(XMLURL, data=payload)
-        except Exception:
-            LOGGER.error("Could not connect to %s", XMLURL)
-            exit(1)
+def record_data(record: AdifRecord) -> bytes:
+    # records created from text have no original bytes
+    return record.data if record.data is not None else record.raw.encode('utf-8')
+
+
+def set_adif_fields(record: AdifRecord, fields: dict) -> bytes:
+    # Sets the given fields (upper-cased name -> value) in the original bytes of a record. Fields present
+    # get their value replaced in place, keeping name and type as written; the others are added
+    # in front of "<eor>". All other bytes are kept as they are and joined once.
+    data = record_data(record)
+    values = {name.encode('ascii'): str(value).encode('utf-8') for name, value in fields.items()}
+    if any('<' in value for value in record.fields.values()):
+        tags = iter_adif_fields(data)
+    else:
+        # without "<" in the values every "<" starts a tag, the fields can be searched for directly
+        tags = re.finditer(rb'<(' + b'|'.join(values) + rb'):(\d+)(?::[^<>]*)?>', data, re.IGNORECASE)
+
+    parts = []
+    position = 0
+    found = set()
+    for tag in tags:
+        name = tag.group(1).upper()
+        if name in values:
+            value = values[name]
+            parts.append(data[position:tag.start()])
+            parts.append(b"<" + tag.group(1) + b":" + str(len(value)).encode('ascii') + data[tag.end(2):tag.end()] + value)
+            position = tag.end() + int(tag.group(2))
+            found.add(name)
+
+    # the record ends with "<eor>"
+    eor = data.rfind(b"<")
+    if eor < position or data[eor:].lower() != b"<eor>":
+        eor = len(data)
+    parts.append(data[position:eor])
+    for name, value in values.items():
+        if name not in found:
+            parts.append(b"<" + name.lower() + b":" + str(len(value)).encode('ascii') + b">" + value + b" ")
+    parts.append(data[eor:])
+    return b"".join(parts)
+
+
+def cached_record(original_record: str, sent_record: str, key: str) -> str:
+    # With QSO fingerprints the record as sent to qrz.com is kept in the cache;
+    # raw hashes have to match the record of the inputfile.
+    if key == original_record:
+        return original_record
+    return sent_record
+
+
+def read_record_cache(file):
+    # Yields hash and record of the entries of a text record cache. Lines not starting with a sha1
+    # hex digest are skipped - e.g. the continuation lines of multi-line records written by older versions.
+    for line in file:
+        record_hash, _, record = line.rstrip('\r\n').partition(':')
+        record_hash = record_hash.strip()
+        if RECORD_HASH.fullmatch(record_hash):
+            yield record_hash, record
+
+
+def find_record_digest(data, digest: bytes) -> int:
+    # binary search in the sorted digests, returns the position the digest is or would be at
+    low = 0
+    high = (len(data) - len(RECORD_BIN_MAGIC)) // 20
+    while low < high:
+        middle = (low + high) // 2
+        start = len(RECORD_BIN_MAGIC) + middle * 20
+        if data[start:start + 20] < digest:
+            low = middle + 1
         else:
-            if response.status_code == 200:
-                doc = xmltodict.parse(response.text)
-
-                if 'Error' in doc['QRZDatabase']['Session']:
-                    LOGGER.error("Error: %s", doc['QRZDatabase']['Session']['Error'])
-                    LOGGER.debug(doc)
-                    LOGGER.debug(response.headers)
-                    LOGGER.debug(response.text)
-                    exit(1)
-                else:
-                    # if no 'Callsign' in the answer for any reason
-                    if 'Key' not in doc['QRZDatabase']['Session']:
-                        LOGGER.error("Could not find session key in xml-response")
-                        LOGGER.debug(response.headers)
-                        LOGGER.debug(response.text)
-                        exit(1)
-                    else:
-                        # success, key is present and readable
-                        XMLKEY = doc['QRZDatabase']['Session']['Key']
-                        LOGGER.debug("Have retrieved and set xmlkey %s", XMLKEY)
-                        LOGGER.info("Successfully retrieved a new session key")
-                        # caching it
-                        try:
-                            file = open(session_key_cache, "w")
-                            file.write(XMLKEY)
-                            file.close()
-                            LOGGER.debug("Written session key into %s", session_key_cache)
-                        except IOError as e:
-                            LOGGER.error("Could not write session key cache file %s", session_key_cache)
-                            LOGGER.error("I/O error({0}): {1}".format(e.errno, e.strerror))
-                            exit(1)
+            high = middle
+    return low
+
+
+def parse_adif(stream, offset: int = 0):
+    # Incremental ADIF parser, reading the binary stream in chunks.
+    # Fields "<name:length[:type]>value" are read by their byte length, so values may
+    # contain "<" or line breaks and records may span multiple lines. Everything up to
+    # "<eoh>" is the header and is skipped. Only the current record is held in memory.
+    buffer = b""
+    base = offset
+    position = 0
+    record_start = 0
+    fields = {}
+    eof = False
+
+    while True:
+        tag = ADIF_TAG.search(buffer, position)
+        value_end = -1
+        if tag is not None and tag.group(2) is not None:
+            value_end = tag.end() + int(tag.group(2))
+
+        # incomplete tag or value - more data is needed
+        if tag is None or value_end > len(buffer):
+            if eof:
+                if fields:
+                    LOGGER.debug("Ignoring incomplete record at the end of input")
+                return
+            if tag is None:
+                # nothing but a partial tag may follow the last "<"
+                position = max(position, buffer.rfind(b"<"), record_start)
+            chunk = stream.read(ADIF_READ_SIZE)
+            if not chunk:
+                eof = True
+            else:
+                # drop everything before the current record
+                buffer = buffer[record_start:] + chunk
+                base += record_start
+                position -= record_start
+                record_start = 0
+            continue
 
+        name = tag.group(1).upper()
+        if value_end >= 0:
+            fields[name.decode('ascii')] = buffer[tag.end():value_end].decode('utf-8', errors='replace')
+            position = value_end
+        elif name == b"EOR":
+            if fields:
+                data = buffer[record_start:tag.end()].strip()
+                yield AdifRecord(fields, data.decode('utf-8', errors='replace'), base + tag.end(), data)
+            fields = {}
+            record_start = position = tag.end()
+        elif name == b"EOH":
+            # fields seen so far were header fields
+            fields = {}
+            record_start = position = tag.end()
+        else:
+            LOGGER.debug("Ignoring unknown tag: %s", tag.group(0))
+            position = tag.end()
 
-def fetch_callsign_data(call: str) -> None:
-    global XMLKEY, XMLURL, USERDATA
 
-    call = call.upper()
+def parse_xml(text: str) -> dict:
+    import xmltodict
 
-    LOGGER.debug("Fetching callsign data for %s", call)
+    return xmltodict.parse(text)
 
-    payload = dict(s=XMLKEY, callsign=call)
 
+def parse_session_time(value) -> float:
+    # times in the <Session> element, e.g. "Sun Aug 16 03:51:47 2015", are in UTC
     try:
-        response = requests.post(XMLURL, data=payload)
-    except Exception:
-        LOGGER.error("Could not connect to %s", XMLURL)
-        exit(1)
-    else:
-        if response.status_code == 200:
-            doc = xmltodict.parse(response.text)
+        return datetime.datetime.strptime(" ".join(str(value).split()), "%a %b %d %H:%M:%S %Y").replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def parse_records(records):
+    # records may be given as AdifRecords or as ADIF text, e.g. as written by the logging program
+    for record in records:
+        if isinstance(record, bytes):
+            yield from parse_adif(io.BytesIO(record))
+        elif isinstance(record, str):
+            yield from parse_adif(io.BytesIO(record.encode('utf-8')))
+        else:
+            yield record
 
-            if 'Error' in doc['QRZDatabase']['Session']:
-                if re.match("Not found.*", doc['QRZDatabase']['Session']['Error']):
-                    LOGGER.info("Call %s was not found on qrz.com", call)
-                else:
-                    LOGGER.error("Some unhandled error occured: %s", doc['QRZDatabase']['Session']['Error'])
-                    LOGGER.debug(response.headers)
-                    LOGGER.debug(response.text)
-                    exit(1)
-            else:
-                if 'Callsign' in doc['QRZDatabase']:
-                    # success, userdata is present and readable
-                    USERDATA = {}
-                    USERDATA = doc['QRZDatabase']['Callsign']
-                else:
-                    # if no 'Callsign' in the answer for any reason
-                    LOGGER.error("Could not find userdata in xml-response body:")
-                    LOGGER.debug(response.headers)
-                    LOGGER.debug(response.text)
-                    exit(1)
 
+def read_adif_records(path: str, offset: int = 0):
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        yield from parse_adif(file, offset)
 
-def fetch_locator():
-    global USERDATA
 
-    if 'grid' in USERDATA:
-        return USERDATA['grid']
-    else:
-        return ""
+def has_records(path: str, offset: int = 0) -> bool:
+    return next(read_adif_records(path, offset), None) is not None
 
 
-def add_record(record: str) -> None:
-    global APIKEY, APIURL
-    global USERDATA
-    global EXITCODE
-    global ADDED_RECORDS
-
-    # filtering of the record in general is not done for simple reason:
-    # - comment/info/<nameit> fields *may* contain language-specific chars
-    # trying to catch all the possibilities is not really useful.
-    # It's up to users program to properly log records.
-    # So will pass the stuff 1:1 to qrz.com.
-    original_record = record
-    record = enrich_record(record)
-
-    LOGGER.debug("Will try to add record \"%s\"", record)
-
-    payload = {'KEY': APIKEY, 'ACTION': 'INSERT', 'ADIF': record}
-    call = ""
-
-    # independently of the xml-lookup availability -
-    # find CALL in record and set it for later use
-    for chunk in record.split('<'):
-        # filtering out weird stuff in fields when looking for a "call"
-        chunk = re.sub(r'[^\w\s:<>\-]+', '', chunk)
-        if chunk == "" or chunk.startswith("eor>") or chunk.startswith("EOR>"):
-            continue
-        else:
-            key = chunk.split(':')[0].lower()
-            value = chunk.split('>')[1]
-            if key == "call":
-                call = value.strip()
+def parse_inputfile(path: str, offset: int = 0) -> list:
+    # runs in a worker process when several inputfiles are read
+    return list(read_adif_records(path, offset))
 
+
+def new_data_size(path: str, offset: int = 0) -> int:
     try:
-        response = requests.post(APIURL, data=payload)
-    except Exception:
-        LOGGER.error("Could not connect to %s", APIURL)
-        exit(1)
-    else:
-        if response.status_code == 200:
-            # noinspection PyTypeChecker
-            params = dict(x.split('=') for x in response.text.split('&'))
+        return os.path.getsize(path) - offset
+    except OSError:
+        return 0
+
+
+def read_inputfiles(offsets: dict, last_records: dict):
+    # Yields the records of all given inputfiles (path -> offset to start at) as one stream,
+    # file by file. The last record read per file is kept in last_records for the checkpoints.
+    # Several small files are parsed in parallel worker processes, one file more than there
+    # are workers is parsed ahead of the uploads. Otherwise - a single file, a single CPU or
+    # large files - the files are streamed one after the other.
+    workers = min(len(offsets), os.cpu_count() or 1)
+    if workers <= 1 or any(new_data_size(path, offset) > PARALLEL_PARSE_MAX_SIZE for path, offset in offsets.items()):
+        for path, offset in offsets.items():
+            for record in read_adif_records(path, offset):
+                last_records[path] = record
+                yield record
+        return
 
-            if 'RESULT' in params:
+    from concurrent.futures import ProcessPoolExecutor
 
-                if params['RESULT'] == "OK":
-                    LOGGER.info("QSO record with %s added", call)
-                    ADDED_RECORDS = ADDED_RECORDS + 1
-                    add_record_to_cache(original_record)
+    LOGGER.debug("Parsing %s inputfiles with %s workers", str(len(offsets)), str(workers))
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending = deque()
+    files = deque(offsets.items())
+    try:
+        while files or pending:
+            while files and len(pending) <= workers:
+                path, offset = files.popleft()
+                pending.append((path, executor.submit(parse_inputfile, path, offset)))
+            path, future = pending.popleft()
+            records = future.result()
+            for record in records:
+                last_records[path] = record
+                yield record
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def expand_inputfiles(patterns: list) -> list:
+    # Directories are expanded to the ADIF files (*.adi, *.adif) in them, glob patterns
+    # to the matching files. Every file is read only once, even if given several times.
+    inputfiles = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths = sorted(os.path.join(pattern, name) for name in os.listdir(pattern)
+                           if name.lower().endswith(ADIF_SUFFIXES) and os.path.isfile(os.path.join(pattern, name)))
+            if not paths:
+                raise QrzError("The directory " + pattern + " contains no ADIF files", 3)
+        elif glob.has_magic(pattern):
+            paths = sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+            if not paths:
+                raise QrzError("No inputfile matches " + pattern, 3)
+        elif os.path.isfile(pattern):
+            paths = [pattern]
+        else:
+            raise QrzError("The inputfile " + pattern + " does not exist", 3)
+
+        for path in paths:
+            if os.path.abspath(path) not in [os.path.abspath(known) for known in inputfiles]:
+                inputfiles.append(path)
+    return inputfiles
+
+
+class RateLimiter:
+    # Token bucket in front of a qrz.com endpoint, adapting to its answers like TCP does (AIMD):
+    # every throttling signal - connection errors, http errors, responses much slower than usual -
+    # halves the rate and the number of parallel requests, every success raises them again a bit.
+    # The rate isn't lowered below what was accepted during the last second, and not more than
+    # once per round-trip. Until the first throttling signal the rate is only limited by max_rate, if given.
+
+    def __init__(self, name: str, max_rate: float = 0.0, max_concurrency: int = 1):
+        self.name = name
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.rate = max_rate
+        self.concurrency = max_concurrency
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.latency = None
+        self.successes = 0
+        self.calm_until = 0.0
+        self.succeeded = deque(maxlen=1000)
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        # waits until a request may be sent
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.rate <= 0:
+                    return
+                # no more requests than run in parallel can be sent at once
+                self.tokens = min(max(1.0, self.concurrency), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def success(self, latency: float) -> None:
+        with self.lock:
+            if self.latency is not None and latency > max(1.0, SLOW_RESPONSE_FACTOR * self.latency):
+                self.decrease("response took " + "{0:.1f}".format(latency) + "s")
+                self.latency = self.latency * (1 - SLOW_RESPONSE_WEIGHT) + latency * SLOW_RESPONSE_WEIGHT
+                return
+            self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+            self.succeeded.append(time.monotonic())
+
+            # additive increase: about one request per second more every second,
+            # one parallel request more after a round of successful ones
+            if self.rate > 0:
+                self.rate = self.rate + 1.0 / self.rate
+                if self.max_rate > 0:
+                    self.rate = min(self.rate, self.max_rate)
+            self.successes = self.successes + 1
+            if self.successes >= self.concurrency:
+                self.successes = 0
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    def throttle(self, reason: str) -> None:
+        with self.lock:
+            self.decrease(reason)
+
+    def decrease(self, reason: str) -> None:
+        # multiplicative decrease, at most once per round-trip - the requests in flight
+        # were sent at the old rate and are likely to fail as well. The rate of the requests
+        # which succeeded during the last second was accepted, it isn't gone below.
+        now = time.monotonic()
+        if now < self.calm_until:
+            return
+        accepted = float(sum(1 for succeeded in self.succeeded if succeeded > now - 1.0))
+        if self.rate > 0:
+            self.rate = max(MIN_RATE, min(self.rate, max(self.rate / 2, accepted)))
+        else:
+            # not limited so far, start from the accepted rate
+            self.rate = max(MIN_RATE, accepted)
+        self.concurrency = max(1, self.concurrency // 2)
+        self.successes = 0
+        self.tokens = min(self.tokens, 1.0)
+        self.calm_until = now + (self.latency if self.latency is not None else 1.0)
+        LOGGER.warning("Slowing down requests to %s to %.1f per second, %s in parallel (%s)", self.name, self.rate,
+                       str(self.concurrency), reason)
+
+
+class PhaseTiming:
+    # Durations of one processing phase in constant memory: count, total and max are kept
+    # exactly, the percentiles come from a uniform random sample of TIMING_SAMPLES durations
+    # (reservoir sampling), so long runs and watch mode don't keep every single duration.
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, duration: float) -> None:
+        self.count = self.count + 1
+        self.total = self.total + duration
+        self.max = max(self.max, duration)
+        if len(self.samples) < TIMING_SAMPLES:
+            self.samples.append(duration)
+        else:
+            index = random.randrange(self.count)
+            if index < TIMING_SAMPLES:
+                self.samples[index] = duration
+
+    def statistics(self) -> dict:
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count,
+            'p50': percentile(samples, 50),
+            'p90': percentile(samples, 90),
+            'p99': percentile(samples, 99),
+            'max': self.max,
+        }
+
+
+class AsyncWriter:
+    # Appends data to files on a background thread. Everything queued while the thread was busy
+    # is written with one write() per file (group commit), the files are kept open and fsync'ed
+    # every WRITER_SYNC_INTERVAL seconds and on flush(). An I/O error is kept and raised
+    # by the next write().
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.files = {}
+        self.error = None
+        self.synced = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name="writer", daemon=True)
+        self.thread.start()
+
+    def write(self, path: str, data, header: str = None) -> None:
+        # header is written first if the file is new or empty
+        if self.error is not None:
+            raise io_error("Could not write into " + self.error[0], self.error[1])
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.queue.put((path, data, header))
+
+    def flush(self):
+        # waits until everything queued so far is written and synced to disk, returns the error if any
+        done = threading.Event()
+        self.queue.put((None, done, None))
+        done.wait()
+        return self.error
+
+    def close(self):
+        error = self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+        return error
+
+    def run(self) -> None:
+        stop = False
+        unsynced = False
+        while not stop:
+            # with data not synced yet, nothing queued must delay the sync beyond WRITER_SYNC_INTERVAL
+            timeout = max(0.0, self.synced + WRITER_SYNC_INTERVAL - time.monotonic()) if unsynced else None
+            try:
+                items = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                items = []
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            chunks = {}
+            headers = {}
+            flushes = []
+            for item in items:
+                if item is None:
+                    stop = True
+                elif item[0] is None:
+                    flushes.append(item[1])
                 else:
-                    FAILED_RECORDS.append(record)
-                    if 'REASON' in params:
-                        reason = params['REASON']
-                    else:
-                        reason = "No failure reasons provided by server"
-                    LOGGER.error("Insert of QSO with %s failed.", call)
-                    LOGGER.error("Server response was: \"%s\"", reason)
-                    LOGGER.debug("Failed record: %s", record)
-                    EXITCODE = 1
+                    chunks.setdefault(item[0], []).append(item[1])
+                    headers.setdefault(item[0], item[2])
+
+            path = None
+            try:
+                for path, data in chunks.items():
+                    if path not in self.files:
+                        self.files[path] = open(path, 'ab')
+                        if headers[path] is not None and self.files[path].tell() == 0:
+                            self.files[path].write(headers[path].encode('utf-8'))
+                    self.files[path].write(b"".join(data))
+                    self.files[path].flush()
+                    unsynced = True
+                if flushes or stop or (unsynced and time.monotonic() - self.synced >= WRITER_SYNC_INTERVAL):
+                    for path, file in self.files.items():
+                        os.fsync(file.fileno())
+                    self.synced = time.monotonic()
+                    unsynced = False
+            except (IOError, OSError) as e:
+                if self.error is None:
+                    self.error = (path, e)
+            for done in flushes:
+                done.set()
+
+
+class XmlSession:
+    # The session key of the qrz.com xml-interface. It's cached in SESSION_KEY_CACHE together with
+    # its issue time and expiry, taken from the <Session> element of the login answer. While fresh,
+    # the cached key is used without asking qrz.com; a key cached by an older version - just the
+    # key - or one beyond its expiry is validated first, a key which can't be validated is replaced
+    # by a new one. The key is only fetched with the first lookup which needs it, and renewed when
+    # it expires during a long run. A key rejected by a lookup is renewed by refresh(): the first
+    # worker logs in again, the others wait on the lock and get the new key. If qrz.com can't be reached no key is returned, the records are
+    # uploaded without lookups then; errors of a login which got an answer raise QrzError.
+
+    def __init__(self, path: str, xml_url: str, username: str, password: str, post, key: str = None):
+        self.path = path
+        self.xml_url = xml_url
+        self.username = username
+        self.password = password
+        # post(url, payload) sends a request, e.g. through the keep-alive session of the Uploader,
+        # and returns the response or None if qrz.com couldn't be reached
+        self.post = post
+        # a key given by the user is used as it is
+        self.key = key
+        self.issued = None
+        self.expires = None
+        self.lock = threading.Lock()
+
+    def get_key(self) -> str:
+        with self.lock:
+            if self.key and self.expires is not None and self.expires <= time.time():
+                LOGGER.info("Session key has expired, getting a new one")
+                self.key = None
+            if not self.key:
+                self.key = self.load()
+            if not self.key:
+                self.login()
+            return self.key
+
+    def refresh(self, stale_key: str) -> str:
+        # returns the key to retry with, either a new one or the one another worker just got
+        with self.lock:
+            if self.key == stale_key:
+                LOGGER.info("Session key was rejected, getting a new one")
+                self.login()
+            return self.key
+
+    def load(self) -> str:
+        # returns the cached key if it's fresh or still valid
+        try:
+            with open(self.path) as file:
+                content = file.read().strip()
+        except IOError:
+            LOGGER.debug("Session file does not exist")
+            return None
 
+        try:
+            cached = json.loads(content) if content.startswith("{") else {'key': content}
+        except ValueError:
+            LOGGER.warning("Session file %s is corrupt and will be replaced", self.path)
+            return None
+        if not cached.get('key'):
+            return None
+
+        if cached.get('expires', 0) > time.time():
+            LOGGER.debug("Session file exists, cached session key %s is fresh", cached['key'])
+            self.issued = cached.get('issued')
+            self.expires = cached['expires']
+            return cached['key']
+
+        LOGGER.debug("Session file exists, cached session key %s", cached['key'])
+        # validate by doing a dxcc fetch for entity 291 (USA)
+        LOGGER.debug("Validating session key")
+        response = self.post(self.xml_url, {'s': cached['key'], 'dxcc': "291"})
+        if response is None:
+            # get_key() falls back to a login, without one the records are uploaded without lookups
+            LOGGER.warning("Could not validate the cached session key, getting a new one")
+            return None
+
+        session = parse_xml(response.text)['QRZDatabase']['Session']
+        if 'Error' in session:
+            if session['Error'] == "Session Timeout":
+                LOGGER.info("Session  is expired")
+            elif session['Error'] == "Invalid session key":
+                LOGGER.info("Session key is no more valid")
+            else:
+                LOGGER.error("An error occured when validating session key: %s", session['Error'])
+            return None
 
-            if 'STATUS' in params:
+        # a valid key is taken as fresh from now on
+        LOGGER.debug("Session key is valid")
+        self.issued = cached.get('issued')
+        self.expires = self.get_expiry(session, time.time())
+        self.save(cached['key'])
+        return cached['key']
 
-                if params['STATUS'] == "FAIL" or params['STATUS'] == "AUTH":
-                    FAILED_RECORDS.append(record)
-                    if 'REASON' in params:
-                        reason = params['REASON']
-                    else:
-                        reason = "No failure reasons provided by server"
-                    if 'EXTENDED' in params:
-                        reason += " " + params['EXTENDED']
-
-                    LOGGER.error("Insert of QSO with %s failed", call)
-                    LOGGER.error("Server response was: \"%s\"", reason)
-                    LOGGER.debug("Failed record: %s", record)
-                    if "duplicate" in reason:
-                        if DELETE_FLAG is False:
-                            LOGGER.info(
-                                "Since servers complain was \"duplicate\" - i assume the record is added to QRZ, so, adding that record to local cache too")
-                            add_record_to_cache(original_record)
-                    EXITCODE = 1
+    def login(self) -> None:
+        LOGGER.debug("Getting a new session key")
+        payload = {'username': self.username, 'password': self.password,
+                   'agent': PROGRAM_NAME + "/" + PROGRAM_VERSION}
+        response = self.post(self.xml_url, payload)
+        if response is None:
+            LOGGER.warning("Could not get a session key from %s", self.xml_url)
+            self.key = None
+            return
+
+        session = parse_xml(response.text)['QRZDatabase']['Session']
+        if 'Error' in session:
+            LOGGER.debug(response.headers)
+            LOGGER.debug(response.text)
+            raise QrzError("Error: " + session['Error'])
+        # if no 'Key' in the answer for any reason
+        if 'Key' not in session:
+            LOGGER.debug(response.headers)
+            LOGGER.debug(response.text)
+            raise QrzError("Could not find session key in xml-response")
+
+        # success, key is present and readable
+        self.key = session['Key']
+        self.issued = parse_session_time(session.get('GMTime')) or time.time()
+        self.expires = self.get_expiry(session, self.issued)
+        LOGGER.debug("Have retrieved and set xmlkey %s", self.key)
+        LOGGER.info("Successfully retrieved a new session key")
+        self.save(self.key)
+
+    @staticmethod
+    def get_expiry(session: dict, since: float) -> float:
+        # a key doesn't outlast the subscription, "SubExp" is missing or no date without one
+        expires = since + SESSION_KEY_TTL
+        subscription_end = parse_session_time(session.get('SubExp'))
+        if subscription_end is not None:
+            expires = min(expires, subscription_end)
+        return expires
+
+    def save(self, key: str) -> None:
+        try:
+            with open(self.path, "w") as file:
+                json.dump({'key': key, 'issued': self.issued, 'expires': self.expires}, file)
+            LOGGER.debug("Written session key into %s", self.path)
+        except IOError as e:
+            raise io_error("Could not write session key cache file " + self.path, e)
+
+
+class Uploader:
+    # Uploads ADIF records into a qrz.com logbook. An Uploader keeps everything belonging
+    # to one logbook - settings, qrz.com session, record and callsign caches, checkpoints
+    # and statistics - so several of them can be used in one process. Its state files are
+    # kept in cache_dir, the current directory by default. Errors raise QrzError. close(), or leaving a "with" block,
+    # writes and closes the caches.
+    #
+    #   with Uploader(apikey, xml_lookups=True, username=..., password=...) as uploader:
+    #       result = uploader.upload(records)
+
+    def __init__(self, apikey: str, api_url: str = APIURL, xml_lookups: bool = False, username: str = "",
+                 password: str = "", xml_key: str = None, xml_url: str = XMLURL, workers: int = WORKERS,
+                 lookup_workers: int = LOOKUP_WORKERS, max_rate: float = 0.0, timeout: float = HTTP_TIMEOUT,
+                 retries: int = HTTP_RETRIES, pool_size: int = 0, cache_backend: str = "text",
+                 fingerprint: str = "qso", callsign_cache_ttl: float = CALLSIGN_CACHE_TTL,
+                 callsign_cache_size: int = CALLSIGN_CACHE_SIZE, checkpoints: bool = True, delete: bool = False,
+                 cache_dir: str = "", enrich_fields: tuple = (), retry_queue: bool = True):
+        if cache_backend not in CACHE_BACKENDS:
+            raise QrzError("Unknown cache backend \"" + cache_backend + "\"", 2)
+        if fingerprint not in FINGERPRINTS:
+            raise QrzError("Unknown fingerprint \"" + fingerprint + "\"", 2)
+        for name in enrich_fields:
+            if name not in ENRICH_FIELDS:
+                raise QrzError("Unknown enrich field \"" + name + "\"", 2)
+
+        self.apikey = apikey
+        self.api_url = api_url
+        self.xml_lookups = xml_lookups
+        self.xml_url = xml_url
+        self.workers = workers
+        self.lookup_workers = lookup_workers
+        # max. number of api inserts per second, 0 means unlimited
+        self.max_rate = max_rate
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.cache_backend = cache_backend
+        self.fingerprint = fingerprint
+        self.callsign_cache_ttl = callsign_cache_ttl
+        self.callsign_cache_size = callsign_cache_size
+        # fields added to looked up records from the qrz.com data, besides the locator
+        self.enrich_fields = tuple(enrich_fields)
+        self.checkpoints_enabled = checkpoints
+        self.retry_queue_enabled = retry_queue
+        # records are not cached when the inputfiles get emptied after the upload
+        self.delete = delete
+        self.cache_dir = cache_dir
+
+        self.http_session = None
+        self.xml_session = XmlSession(self.path(SESSION_KEY_CACHE), xml_url, username, password, self.xml_post,
+                                      xml_key)
+        # adaptive rate limiters per qrz.com endpoint, "api" and "xml"
+        self.rate_limiters = {}
+        self.rate_lock = threading.Lock()
+        self.callsign_data = None
+        self.callsign_cache_changed = False
+        self.callsign_lock = threading.Lock()
+        self.record_index = None
+        self.record_db = None
+        self.record_db_pending = 0
+        self.record_bin = None
+        self.record_bin_new = set()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.checkpoints = None
+        # record fingerprint hash -> record, reason, attempts, first_failed, last_failed and next_attempt;
+        # the entries taken for the current run are kept aside until the upload is through
+        self.retry_queue = None
+        self.retry_taken = {}
+        self.retry_queue_changed = False
+        # records failed for a transient reason which are not in the retry queue, the checkpoints stop before them
+        self.unqueued_failures = []
+        self.failed_records_file = None
+        # failed records streamed into the failed records file, and the ones of them reported as written
+        self.failed_records_streamed = 0
+        self.failed_records_written = 0
+        # durations of the single steps of the record processing, a PhaseTiming per phase
+        self.phase_timings = {}
+        self.timing_lock = threading.Lock()
+
+        self.processed = 0
+        self.added = 0
+        self.ignored = 0
+        self.cached = 0
+        self.failed_records = []
+        self.parked = 0
+        self.synced = 0
+        self.retried = 0
+        # failed requests in a row per endpoint, "api" and "xml"
+        self.connection_failures = {}
+        # set when xmldata.qrz.com could not be reached, no more lookups are tried then
+        self.xml_unreachable = False
+        # guards counters, failed records and the record cache when uploading with several workers
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name)
+
+    @property
+    def exitcode(self) -> int:
+        return 1 if self.failed_records else 0
+
+    def fetch_callsign_data(self, call: str) -> dict:
+        call = call.upper()
+
+        LOGGER.debug("Fetching callsign data for %s", call)
+        userdata = {}
+
+        if self.xml_unreachable:
+            return None
+
+        xml_key = self.xml_session.get_key()
+        for attempt in range(2):
+            if xml_key is None:
+                LOGGER.warning("Could not look up %s on qrz.com without a session key", call)
+                return None
+            payload = dict(s=xml_key, callsign=call)
+
+            # if the lookup fails the record is uploaded as it is - None is returned then
+            response = self.post_with_retries("xml", self.xml_url, payload, "xml_lookup")
+            if response is None:
+                if not self.xml_unreachable:
+                    LOGGER.warning("Could not look up %s on qrz.com", call)
+                return None
+
+            doc = parse_xml(response.text)
+
+            # a key which timed out is replaced - once - and the lookup repeated
+            error = doc['QRZDatabase']['Session'].get('Error')
+            if attempt > 0 or error not in SESSION_ERRORS:
+                break
+            LOGGER.info("Lookup of %s failed: %s", call, error)
+            xml_key = self.xml_session.refresh(xml_key)
+
+        if 'Error' in doc['QRZDatabase']['Session']:
+            if re.match("Not found.*", doc['QRZDatabase']['Session']['Error']):
+                LOGGER.info("Call %s was not found on qrz.com", call)
+            else:
+                LOGGER.debug(response.headers)
+                LOGGER.debug(response.text)
+                raise QrzError("Some unhandled error occured: " + doc['QRZDatabase']['Session']['Error'])
+        else:
+            if 'Callsign' in doc['QRZDatabase']:
+                # success, userdata is present and readable
+                userdata = doc['QRZDatabase']['Callsign']
+            else:
+                # if no 'Callsign' in the answer for any reason
+                LOGGER.debug(response.headers)
+                LOGGER.debug(response.text)
+                raise QrzError("Could not find userdata in xml-response body")
+
+        return userdata
+
+    def load_callsign_cache(self) -> None:
+        # entries are kept in least recently used order:
+        # callsign -> [timestamp of the lookup, qrz.com userdata or null if not found]
+        self.callsign_data = OrderedDict()
+        callsign_cache = self.path(CALLSIGN_CACHE)
+        try:
+            with open(callsign_cache, 'r') as file:
+                self.callsign_data = json.load(file, object_pairs_hook=OrderedDict)
+        except IOError:
+            LOGGER.debug("Callsign cache file does not exist")
+        except ValueError:
+            LOGGER.warning("Callsign cache file %s is corrupted, starting with an empty cache", callsign_cache)
+        else:
+            LOGGER.debug("Loaded %s entries from callsign cache %s", str(len(self.callsign_data)), callsign_cache)
+
+    def save_callsign_cache(self) -> None:
+        with self.callsign_lock:
+            if not self.callsign_cache_changed:
+                return
+            # written into a temporary file first, so an interrupted run can't leave a broken cache
+            callsign_cache = self.path(CALLSIGN_CACHE)
+            temp_file = callsign_cache + ".tmp"
+            try:
+                with open(temp_file, "w") as file:
+                    json.dump(self.callsign_data, file)
+                os.replace(temp_file, callsign_cache)
+            except (IOError, OSError) as e:
+                LOGGER.error("Could not write callsign cache file %s", callsign_cache)
+                LOGGER.error("I/O error({0}): {1}".format(e.errno, e.strerror))
+            else:
+                self.callsign_cache_changed = False
+                LOGGER.debug("Written %s entries into callsign cache %s", str(len(self.callsign_data)),
+                             callsign_cache)
+
+    def lookup_callsign(self, call: str) -> dict:
+        call = call.upper()
+
+        if self.callsign_cache_ttl <= 0:
+            return self.fetch_callsign_data(call) or {}
+
+        with self.callsign_lock:
+            if self.callsign_data is None:
+                self.load_callsign_cache()
+
+            entry = self.callsign_data.get(call)
+            if entry is not None:
+                ttl = self.callsign_cache_ttl
+                if entry[1] is None:
+                    ttl = min(ttl, CALLSIGN_CACHE_NEGATIVE_TTL)
+                if time.time() - entry[0] < ttl * 86400:
+                    LOGGER.debug("Callsign data for %s found in callsign cache", call)
+                    # the new order is saved as well, otherwise the callsigns only ever hit
+                    # would drift to the front of the file and get evicted first
+                    self.callsign_data.move_to_end(call)
+                    self.callsign_cache_changed = True
+                    return entry[1] or {}
+
+        userdata = self.fetch_callsign_data(call)
+        # failed lookups are not cached
+        if userdata is None:
+            return {}
+
+        with self.callsign_lock:
+            # "not found" answers are cached as well, but for a shorter time
+            self.callsign_data[call] = [time.time(), userdata or None]
+            self.callsign_data.move_to_end(call)
+            while len(self.callsign_data) > self.callsign_cache_size:
+                self.callsign_data.popitem(last=False)
+            self.callsign_cache_changed = True
+
+        return userdata
+
+    @contextmanager
+    def timed(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self.timing_lock:
+                if phase not in self.phase_timings:
+                    self.phase_timings[phase] = PhaseTiming()
+                self.phase_timings[phase].add(duration)
+
+    def timed_iter(self, phase: str, iterable):
+        # times the production of every single item, e.g. the parsing of a record
+        iterator = iter(iterable)
+        while True:
+            with self.timed(phase):
+                item = next(iterator, None)
+            if item is None:
+                return
+            yield item
+
+    def get_phase_statistics(self) -> dict:
+        phases = {}
+        with self.timing_lock:
+            for phase, timing in self.phase_timings.items():
+                phases[phase] = timing.statistics()
+        return phases
+
+    def stats(self) -> dict:
+        return {
+            'records': {
+                'processed': self.processed,
+                'added': self.added,
+                'ignored': self.ignored,
+                'cached': self.cached,
+                'failed': len(self.failed_records),
+                'parked': self.parked,
+                'synced': self.synced,
+                'retried': self.retried,
+                'queued': len(self.retry_queue or ()),
+            },
+            # the state of the adaptive rate limiters
+            'rate_limiters': {endpoint: {'rate': limiter.rate, 'concurrency': limiter.concurrency}
+                              for endpoint, limiter in self.rate_limiters.items()},
+            # durations are in seconds
+            'phases': self.get_phase_statistics(),
+        }
+
+    def log_statistics(self) -> None:
+        stats = "Run statistics - " + str(self.processed) + " records processed: "
+        name_plural = "records"
+        name_singular = "record"
+        if self.added > 0:
+            records_name = name_plural
+            if self.added == 1:
+                records_name = name_singular
+            stats = stats + str(self.added) + " new " + records_name + " added. "
+        if self.ignored > 0:
+            records_name = name_plural
+            if self.ignored == 1:
+                records_name = name_singular
+            stats = stats + str(self.ignored) + " cached " + records_name + " ignored. "
+        if len(self.failed_records) > 0:
+            records_name = name_plural
+            if len(self.failed_records) == 1:
+                records_name = name_singular
+            stats = stats + str(len(self.failed_records)) + " " + records_name + " failed. "
+        if self.retried > 0:
+            stats = stats + str(self.retried) + " taken from the retry queue, " + str(
+                len(self.retry_queue or ())) + " left in it."
+
+        if self.cached > 0 or self.added > 0 or len(self.failed_records) > 0 or self.retried > 0:
+            LOGGER.info(stats)
+
+        for phase, timing in self.get_phase_statistics().items():
+            LOGGER.debug("Phase %s: %s calls, %.3fs total, p50 %.1fms, p90 %.1fms, p99 %.1fms", phase,
+                         str(timing['count']), timing['total'], timing['p50'] * 1000, timing['p90'] * 1000,
+                         timing['p99'] * 1000)
+
+    def get_http_session(self):
+        # One keep-alive session shared by all qrz.com calls. The connection pool is sized to
+        # the number of parallel uploads/lookups unless given explicitly. Transient server errors
+        # are retried with an exponential backoff. Connection errors and timeouts are not, the records
+        # are parked and retried later in the run instead; throttling answers (429, 503) are left
+        # to the rate limiters, they slow down all requests.
+        if self.http_session is None:
+            import requests
+            from urllib3.util import Retry
+
+            retries = Retry(total=self.retries, connect=0, read=0, backoff_factor=HTTP_BACKOFF,
+                            status_forcelist=(500, 502, 504), allowed_methods=None,
+                            raise_on_status=False, respect_retry_after_header=True)
+            pool_size = self.pool_size or max(self.workers, self.lookup_workers, 1)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retries)
+            self.http_session = requests.Session()
+            self.http_session.headers['User-Agent'] = PROGRAM_NAME + "/" + PROGRAM_VERSION
+            self.http_session.mount("https://", adapter)
+            self.http_session.mount("http://", adapter)
+        return self.http_session
+
+    def http_post(self, url: str, payload: dict):
+        return self.get_http_session().post(url, data=payload, timeout=self.timeout)
+
+    def connection_failed(self, endpoint: str, url: str) -> bool:
+        # Counts the failed requests in a row per endpoint. After MAX_CONNECTION_FAILURES of them
+        # QrzError is raised for the logbook api, instead of parking and retrying every record at
+        # the lowest rate for hours. The xml-lookups are given up for the rest of the run instead,
+        # the records are uploaded as they are - True is returned then. For the xml-interface
+        # http errors count as well.
+        with self.lock:
+            failures = self.connection_failures.get(endpoint, 0) + 1
+            self.connection_failures[endpoint] = failures
+            if failures < MAX_CONNECTION_FAILURES:
+                return False
+            if endpoint == "xml":
+                if not self.xml_unreachable:
+                    LOGGER.warning("Requests to %s failed %s times in a row, uploading the records without "
+                                   "xml-lookups", url, str(failures))
+                    self.xml_unreachable = True
+                return True
+        raise QrzError("Could not connect to {0} {1} times in a row, giving up".format(url, failures))
+
+    def get_rate_limiter(self, endpoint: str) -> RateLimiter:
+        # one limiter for uploads to the logbook api and one for the xml-lookups;
+        # max_rate applies to the uploads
+        with self.rate_lock:
+            if endpoint not in self.rate_limiters:
+                if endpoint == "api":
+                    self.rate_limiters[endpoint] = RateLimiter(self.api_url, self.max_rate, self.workers)
+                else:
+                    self.rate_limiters[endpoint] = RateLimiter(self.xml_url, 0.0, self.lookup_workers)
+            return self.rate_limiters[endpoint]
+
+    def post_with_retries(self, endpoint: str, url: str, payload: dict, phase: str):
+        # Connection problems and http errors are retried with an increasing delay,
+        # the requests go through the rate limiter of the endpoint.
+        # Returns the response, or None if all attempts failed.
+        if endpoint == "xml" and self.xml_unreachable:
+            return None
+        limiter = self.get_rate_limiter(endpoint)
+        for attempt in range(PARK_RETRIES + 1):
+            if attempt > 0:
+                time.sleep(HTTP_BACKOFF * 2 ** (attempt - 1))
+            limiter.acquire()
+            start = time.perf_counter()
+            try:
+                with self.timed(phase):
+                    response = self.http_post(url, payload)
+            except Exception:
+                LOGGER.warning("Could not connect to %s", url)
+                limiter.throttle("connection failed")
+                if self.connection_failed(endpoint, url):
+                    return None
+                continue
+            if response.status_code == 200:
+                self.connection_failures[endpoint] = 0
+                limiter.success(time.perf_counter() - start)
+                return response
+            LOGGER.warning("The server %s responded with http-code %s", url, str(response.status_code))
+            limiter.throttle("http-code " + str(response.status_code))
+            if endpoint != "xml":
+                self.connection_failures[endpoint] = 0
+            elif self.connection_failed(endpoint, url):
+                return None
+        return None
+
+    def xml_post(self, url: str, payload: dict):
+        # session key validation and login of the XmlSession, retried and given up like the lookups
+        return self.post_with_retries("xml", url, payload, "xml_lookup")
+
+    def add_record(self, record: AdifRecord, resolved: dict = None) -> bool:
+        # Returns False if the record could not be sent, e.g. while qrz.com is throttling;
+        # it is retried later then. Any answer of qrz.com - success or not - returns True.
+
+        # filtering of the record in general is not done for simple reason:
+        # - comment/info/<nameit> fields *may* contain language-specific chars
+        # trying to catch all the possibilities is not really useful.
+        # It's up to users program to properly log records.
+        # So will pass the stuff 1:1 to qrz.com.
+        source = record
+        original_record = record.raw
+        key = self.record_fingerprint(record)
+        call = record.fields.get('CALL', '').strip()
+        with self.timed("adif_rebuild"):
+            adif = self.enrich_record(record, resolved)
+        # the bytes are sent as read, the text is logged and kept in the caches
+        record = adif.decode('utf-8', errors='replace')
+
+        LOGGER.debug("Will try to add record \"%s\"", record)
+
+        payload = {'KEY': self.apikey, 'ACTION': 'INSERT', 'ADIF': adif}
+
+        limiter = self.get_rate_limiter("api")
+        limiter.acquire()
+        start = time.perf_counter()
+        try:
+            with self.timed("api_post"):
+                response = self.http_post(self.api_url, payload)
+        except Exception:
+            LOGGER.warning("Could not connect to %s, will retry the QSO with %s later", self.api_url, call)
+            limiter.throttle("connection failed")
+            self.connection_failed("api", self.api_url)
+            return False
         else:
-            LOGGER.error(
-                "The server responded with http-code %s upon submission of QSO with %s", str(response.status_code),
-                call)
-            exit(1)
+            self.connection_failures["api"] = 0
+            if response.status_code == 200:
+                limiter.success(time.perf_counter() - start)
+                # noinspection PyTypeChecker
+                params = dict(x.split('=') for x in response.text.split('&'))
+
+                if 'RESULT' in params:
+
+                    if params['RESULT'] == "OK":
+                        LOGGER.info("QSO record with %s added", call)
+                        with self.lock:
+                            self.added = self.added + 1
+                        self.add_record_to_cache(cached_record(original_record, record, key),
+                                                 logid=params.get('LOGID'), key=key)
+                    else:
+                        if 'REASON' in params:
+                            reason = params['REASON']
+                        else:
+                            reason = "No failure reasons provided by server"
+                        LOGGER.error("Insert of QSO with %s failed.", call)
+                        LOGGER.error("Server response was: \"%s\"", reason)
+                        LOGGER.debug("Failed record: %s", record)
+                        self.add_failed_record(record, reason, source)
+                        self.add_record_to_cache(cached_record(original_record, record, key), "failed",
+                                                 reason=reason, key=key)
+
 
+                if 'STATUS' in params:
 
-def find_cached_record(record: str) -> bool:
-    global IGNORED_RECORDS
+                    if params['STATUS'] == "FAIL" or params['STATUS'] == "AUTH":
+                        if 'REASON' in params:
+                            reason = params['REASON']
+                        else:
+                            reason = "No failure reasons provided by server"
+                        if 'EXTENDED' in params:
+                            reason += " " + params['EXTENDED']
+
+                        LOGGER.error("Insert of QSO with %s failed", call)
+                        LOGGER.error("Server response was: \"%s\"", reason)
+                        LOGGER.debug("Failed record: %s", record)
+                        # a rejected api key is not retried, whatever the reason says
+                        self.add_failed_record(record, reason, source, params['STATUS'] == "AUTH")
+                        if "duplicate" in reason:
+                            if self.delete is False:
+                                LOGGER.info(
+                                    "Since servers complain was \"duplicate\" - i assume the record is added to QRZ, so, adding that record to local cache too")
+                                self.add_record_to_cache(cached_record(original_record, record, key), "duplicate",
+                                                         reason=reason, key=key)
+                        else:
+                            self.add_record_to_cache(cached_record(original_record, record, key), "failed",
+                                                     reason=reason, key=key)
+            else:
+                LOGGER.warning(
+                    "The server responded with http-code %s upon submission of QSO with %s, will retry it later",
+                    str(response.status_code), call)
+                limiter.throttle("http-code " + str(response.status_code))
+                return False
+        return True
+
+    def get_writer(self) -> AsyncWriter:
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = AsyncWriter()
+            return self.writer
+
+    def write_async(self, path: str, data, header: str = None) -> None:
+        self.get_writer().write(path, data, header)
+
+    def flush_writes(self) -> None:
+        # waits until everything written so far is on disk
+        with self.writer_lock:
+            writer = self.writer
+        if writer is None:
+            return
+        error = writer.flush()
+        if error is not None:
+            raise io_error("Could not write into " + error[0], error[1])
+
+    def close_writer(self) -> None:
+        with self.writer_lock:
+            writer = self.writer
+            self.writer = None
+        if writer is not None:
+            error = writer.close()
+            if error is not None:
+                raise io_error("Could not write into " + error[0], error[1])
+
+    def open_record_db(self) -> None:
+        record_cache_db = self.path(RECORD_CACHE_DB)
+        migrate = not os.path.exists(record_cache_db)
+        try:
+            self.record_db = sqlite3.connect(record_cache_db, check_same_thread=False)
+            self.record_db.execute("PRAGMA journal_mode=WAL")
+            self.record_db.execute("CREATE TABLE IF NOT EXISTS records ("
+                                   "hash TEXT PRIMARY KEY, status TEXT NOT NULL, timestamp TEXT NOT NULL, "
+                                   "logid TEXT, reason TEXT, record TEXT)")
+            self.record_db.execute("CREATE INDEX IF NOT EXISTS records_status ON records (status)")
+            self.record_db.commit()
+        except sqlite3.Error as e:
+            raise QrzError("Could not open record cache database " + record_cache_db + ": " + str(e))
+
+        # a new database takes over the entries of an existing text cache
+        if migrate and os.path.isfile(self.path(RECORD_CACHE)):
+            self.migrate_record_cache()
+
+    def migrate_record_cache(self) -> None:
+        record_cache = self.path(RECORD_CACHE)
+        LOGGER.info("Migrating record cache %s into %s", record_cache, self.path(RECORD_CACHE_DB))
+        timestamp = datetime.datetime.fromtimestamp(os.path.getmtime(record_cache)).isoformat(timespec='seconds')
+
+        def entries(file):
+            for record_hash, record in read_record_cache(file):
+                yield record_hash, "added", timestamp, record or None
 
-    LOGGER.debug("Looking for record in cache: %s", str(record))
-    record_hash = sha1(record.encode('utf-8')).hexdigest()
+        try:
+            with open(record_cache, 'r') as file, self.record_db:
+                self.record_db.executemany("INSERT OR IGNORE INTO records (hash, status, timestamp, record) "
+                                           "VALUES (?, ?, ?, ?)", entries(file))
+        except (IOError, sqlite3.Error) as e:
+            raise QrzError("Could not migrate record cache " + record_cache + ": " + str(e))
+        count = self.record_db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        LOGGER.info("Migrated %s records into %s", str(count), self.path(RECORD_CACHE_DB))
+
+    def close_record_db(self) -> None:
+        with self.lock:
+            if self.record_db is not None:
+                self.record_db.commit()
+                self.record_db.close()
+                self.record_db = None
+                self.record_db_pending = 0
+
+    def open_record_bin(self) -> None:
+        record_cache_bin = self.path(RECORD_CACHE_BIN)
+        # a new binary cache takes over the entries of an existing text cache
+        if not os.path.exists(record_cache_bin):
+            digests = set()
+            record_cache = self.path(RECORD_CACHE)
+            if os.path.isfile(record_cache):
+                LOGGER.info("Migrating record cache %s into %s", record_cache, record_cache_bin)
+                try:
+                    with open(record_cache, 'r') as file:
+                        for record_hash, _ in read_record_cache(file):
+                            digests.add(bytes.fromhex(record_hash))
+                except (IOError, ValueError) as e:
+                    raise QrzError("Could not migrate record cache " + record_cache + ": " + str(e))
+            self.write_record_bin(sorted(digests))
+            LOGGER.debug("Written %s digests into %s", str(len(digests)), record_cache_bin)
 
-    try:
-        with open(RECORD_CACHE, 'r') as file:
-            # Read all lines in the file one by one
-            for line in file:
-                # For each line, check if line contains the string
-                if record_hash in line:
-                    LOGGER.debug("Hash entry %s for record \"%s\" found in cache", record_hash, record)
-                    LOGGER.debug("Will not try to add that entry to logbook")
-                    IGNORED_RECORDS = IGNORED_RECORDS + 1
-                    return True
-    except IOError:
-        LOGGER.debug("Record cache file does not exist")
+        try:
+            with open(record_cache_bin, 'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                if file.read(len(RECORD_BIN_MAGIC)) != RECORD_BIN_MAGIC or (size - len(RECORD_BIN_MAGIC)) % 20 != 0:
+                    raise QrzError("Record cache " + record_cache_bin + " is corrupted")
+                # an empty file can't be mapped
+                if size > len(RECORD_BIN_MAGIC):
+                    self.record_bin = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self.record_bin = RECORD_BIN_MAGIC
+
+            # digests added by an interrupted run are still in the journal
+            journal = record_cache_bin + ".journal"
+            if os.path.isfile(journal):
+                with open(journal, 'rb') as file:
+                    data = file.read()
+                for position in range(0, len(data) - len(data) % 20, 20):
+                    self.record_bin_new.add(data[position:position + 20])
+                # a partly written digest of a killed run is cut off, new ones are appended behind the last whole one
+                if len(data) % 20 != 0:
+                    os.truncate(journal, len(data) - len(data) % 20)
+        except (IOError, OSError) as e:
+            raise io_error("Could not open record cache " + record_cache_bin, e)
+        LOGGER.debug("Opened record cache %s with %s digests", record_cache_bin,
+                     str((len(self.record_bin) - len(RECORD_BIN_MAGIC)) // 20 + len(self.record_bin_new)))
+
+    def has_record_digest(self, digest: bytes) -> bool:
+        if digest in self.record_bin_new:
+            return True
+        start = len(RECORD_BIN_MAGIC) + find_record_digest(self.record_bin, digest) * 20
+        return self.record_bin[start:start + 20] == digest
+
+    def write_record_bin(self, digests, data=None) -> None:
+        # Writes the sorted digests into a new cache file, merged with the ones of the current file (data).
+        # The file is replaced at once, so an interrupted run can't leave a broken cache. A mapped
+        # current file is closed before, Windows doesn't replace files which are still mapped.
+        record_cache_bin = self.path(RECORD_CACHE_BIN)
+        temp_file = record_cache_bin + ".tmp"
+        try:
+            with open(temp_file, 'wb') as file:
+                file.write(RECORD_BIN_MAGIC)
+                if data is None:
+                    file.write(b"".join(digests))
+                else:
+                    # only the new digests are placed, the ranges between them are copied as they are
+                    with memoryview(data) as view:
+                        position = len(RECORD_BIN_MAGIC)
+                        for digest in digests:
+                            start = len(RECORD_BIN_MAGIC) + find_record_digest(data, digest) * 20
+                            # e.g. journal entries of a run interrupted while merging
+                            if data[start:start + 20] == digest:
+                                continue
+                            file.write(view[position:start])
+                            file.write(digest)
+                            position = start
+                        file.write(view[position:])
+                file.flush()
+                os.fsync(file.fileno())
+            if isinstance(data, mmap.mmap):
+                data.close()
+            os.replace(temp_file, record_cache_bin)
+        except (IOError, OSError) as e:
+            raise io_error("Could not write record cache " + record_cache_bin, e)
+
+    def merge_record_bin(self) -> None:
+        # the new digests are merged into the cache file, the journal is emptied afterwards
+        if not self.record_bin_new:
+            return
+        self.flush_writes()
+        record_cache_bin = self.path(RECORD_CACHE_BIN)
+        LOGGER.debug("Merging %s new digests into %s", str(len(self.record_bin_new)), record_cache_bin)
+        try:
+            self.write_record_bin(sorted(self.record_bin_new), self.record_bin)
+        finally:
+            # mapped again, the new file or - if it couldn't be written - the old one
+            if isinstance(self.record_bin, mmap.mmap) and not self.record_bin.closed:
+                self.record_bin.close()
+            with open(record_cache_bin, 'rb') as file:
+                self.record_bin = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.record_bin_new = set()
+        os.truncate(record_cache_bin + ".journal", 0)
+
+    def close_record_bin(self) -> None:
+        # the journal has to be complete and closed before it gets merged and removed
+        self.close_writer()
+        with self.lock:
+            if self.record_bin is None:
+                return
+            self.merge_record_bin()
+            journal = self.path(RECORD_CACHE_BIN) + ".journal"
+            if os.path.isfile(journal):
+                os.remove(journal)
+            if isinstance(self.record_bin, mmap.mmap):
+                self.record_bin.close()
+            self.record_bin = None
+
+    def load_record_cache(self) -> None:
+        if self.cache_backend == "sqlite":
+            self.open_record_db()
+            return
+        if self.cache_backend == "binary":
+            self.open_record_bin()
+            return
+
+        # the cache is read only once per run - every line starts with the sha1 of the record,
+        # followed by a colon and the record itself. Only the hashes are kept in memory.
+        self.record_index = set()
+        record_cache = self.path(RECORD_CACHE)
+        try:
+            with open(record_cache, 'r') as file:
+                for record_hash, _ in read_record_cache(file):
+                    self.record_index.add(record_hash)
+        except IOError:
+            LOGGER.debug("Record cache file does not exist")
+        else:
+            LOGGER.debug("Loaded %s hashes from record cache %s", str(len(self.record_index)), record_cache)
+
+    def record_fingerprint(self, record: AdifRecord) -> str:
+        # The identity of a QSO - call, date, start time to the minute, band, mode and own call -
+        # independent of the field order, case, whitespace and any other fields of the record.
+        # Records without call, date or time are identified by their raw text.
+        fields = record.fields
+        if self.fingerprint == "raw" or not all(fields.get(name, '').strip()
+                                                for name in ('CALL', 'QSO_DATE', 'TIME_ON')):
+            return record.raw
+        values = [fields.get(name, '').strip().upper() for name in FINGERPRINT_FIELDS]
+        values[2] = values[2][:4]
+        return "QSO:" + "|".join(values)
+
+    def is_record_cached(self, record: AdifRecord) -> bool:
+        # Caches written before the QSO fingerprints were introduced contain hashes of the raw records.
+        # Records found that way are added with their fingerprint, so re-exports are found later too.
+        key = self.record_fingerprint(record)
+        if self.find_cached_record(key):
+            return True
+        if key != record.raw and self.find_cached_record(record.raw):
+            self.add_record_to_cache(record.raw, key=key)
+            return True
         return False
-    file.close()
-    return False
 
+    def find_cached_record(self, record: str) -> bool:
+        if self.record_index is None and self.record_db is None and self.record_bin is None:
+            self.load_record_cache()
+
+        LOGGER.debug("Looking for record in cache: %s", str(record))
+        record_sha1 = sha1(record.encode('utf-8'))
+        record_hash = record_sha1.hexdigest()
+
+        with self.lock:
+            if self.record_db is not None:
+                # failed uploads are kept in the database too, but are not considered as cached
+                found = self.record_db.execute("SELECT 1 FROM records WHERE hash = ? AND status != 'failed'",
+                                               (record_hash,)).fetchone() is not None
+            elif self.record_bin is not None:
+                found = self.has_record_digest(record_sha1.digest())
+            else:
+                found = record_hash in self.record_index
 
-def add_record_to_cache(record: str) -> None:
-    global DELETE_FLAG
-    global CACHED_RECORDS
+            if found:
+                LOGGER.debug("Hash entry %s for record \"%s\" found in cache", record_hash, record)
+                LOGGER.debug("Will not try to add that entry to logbook")
+                self.ignored = self.ignored + 1
+                return True
+        return False
 
-    if DELETE_FLAG:
-        LOGGER.debug("Delete-flag is active - will not add the entry to cache")
-    else:
-        LOGGER.debug("Adding record to cache: %s", str(record))
-        record_hash = sha1(record.encode('utf-8')).hexdigest()
+    def add_record_to_cache(self, record: str, status: str = "added", logid: str = None, reason: str = None,
+                            key: str = None) -> None:
+        if self.delete:
+            LOGGER.debug("Delete-flag is active - will not add the entry to cache")
+        elif status == "failed" and self.record_db is None:
+            # only the database keeps track of failed uploads
+            return
+        else:
+            LOGGER.debug("Adding record to cache: %s", str(record))
+            # the record is stored under the hash of its fingerprint, if given
+            record_sha1 = sha1((key or record).encode('utf-8'))
+            record_hash = record_sha1.hexdigest()
+            with self.timed("cache_write"), self.lock:
+                if self.record_db is not None:
+                    # writes are committed in batches, the rest is committed on exit
+                    try:
+                        self.record_db.execute(
+                            "INSERT OR REPLACE INTO records (hash, status, timestamp, logid, reason, record) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (record_hash, status, datetime.datetime.now().isoformat(timespec='seconds'),
+                             logid, reason, record))
+                        self.record_db_pending = self.record_db_pending + 1
+                        if self.record_db_pending >= RECORD_DB_BATCH_SIZE:
+                            self.record_db.commit()
+                            self.record_db_pending = 0
+                    except sqlite3.Error as e:
+                        raise QrzError("Could not write into record cache database {0}: {1}".format(
+                            self.path(RECORD_CACHE_DB), str(e)))
+                    if status != "failed":
+                        self.cached = self.cached + 1
+                    return
+
+                if self.record_bin is not None:
+                    # new digests go into the journal first, they are merged into the cache file on exit
+                    digest = record_sha1.digest()
+                    if not self.has_record_digest(digest):
+                        self.record_bin_new.add(digest)
+                        self.write_async(self.path(RECORD_CACHE_BIN) + ".journal", digest)
+                        if len(self.record_bin_new) >= RECORD_BIN_MERGE_SIZE:
+                            self.merge_record_bin()
+                    self.cached = self.cached + 1
+                    return
+
+                # one line per entry, records spanning several lines are joined
+                self.write_async(self.path(RECORD_CACHE), record_hash + ":" + " ".join(record.splitlines()) + os.linesep)
+                self.cached = self.cached + 1
+                if self.record_index is not None:
+                    self.record_index.add(record_hash)
+
+    def unload_record_cache(self) -> None:
+        self.close_record_bin()
+        self.close_record_db()
+        self.record_index = None
+
+    def time_record_cache(self, lookups: int = 1000) -> tuple:
+        # Returns the time it takes to load the record cache and the average time of a lookup
+        # of a record which is not cached - the common case of an upload.
+        self.unload_record_cache()
+        start = time.perf_counter()
+        self.load_record_cache()
+        loaded = time.perf_counter()
+        for i in range(lookups):
+            self.find_cached_record("compact-cache-probe:" + str(i))
+        looked_up = time.perf_counter()
+        self.unload_record_cache()
+        return loaded - start, (looked_up - loaded) / lookups
+
+    def is_superseded(self, record_hash: str, record: str, parsed: AdifRecord, hashes) -> bool:
+        # An entry of the raw record, as written before the QSO fingerprints, isn't needed
+        # anymore once the fingerprint of the same QSO is cached too.
+        if self.fingerprint == "raw" or parsed is None:
+            return False
+        key = self.record_fingerprint(parsed)
+        if key == parsed.raw or sha1(record.encode('utf-8')).hexdigest() != record_hash:
+            return False
+        return sha1(key.encode('utf-8')).hexdigest() in hashes
+
+    def compact_record_cache(self, hashes_only: bool = False, max_age: int = 0) -> CompactResult:
+        # Rewrites the record cache without duplicate and superseded entries, optionally keeping
+        # only the hashes and dropping entries of QSOs older than max_age days.
+        self.unload_record_cache()
+        if self.cache_backend == "sqlite":
+            return self.compact_record_db(hashes_only, max_age)
+        if self.cache_backend == "binary":
+            return self.compact_record_bin(max_age)
+        return self.compact_record_text(hashes_only, max_age)
+
+    def compact_record_text(self, hashes_only: bool, max_age: int) -> CompactResult:
+        # The age of an entry is the QSO_DATE of its record, entries without a record are kept.
+        # The compacted cache is written into a temporary file first, then replaces the cache at once.
+        record_cache = self.path(RECORD_CACHE)
+        if not os.path.isfile(record_cache):
+            LOGGER.info("Record cache %s does not exist, nothing to compact", record_cache)
+            return CompactResult(record_cache, 0, 0, 0, 0)
+
+        size = os.path.getsize(record_cache)
+        entries = OrderedDict()
+        count = 0
         try:
-            f = open(RECORD_CACHE, "a")
-            f.write(record_hash + ":" + record + os.linesep)
-            f.close()
-            CACHED_RECORDS = CACHED_RECORDS + 1
+            with open(record_cache, 'r', encoding='utf-8', errors='replace') as file:
+                for record_hash, record in read_record_cache(file):
+                    count = count + 1
+                    if record or record_hash not in entries:
+                        entries[record_hash] = record
         except IOError as e:
-            LOGGER.error("Could not write into record_cache cache file %s", RECORD_CACHE)
+            raise io_error("Could not read record cache " + record_cache, e)
+
+        oldest = ""
+        if max_age > 0:
+            oldest = (datetime.date.today() - datetime.timedelta(days=max_age)).strftime("%Y%m%d")
+
+        kept = 0
+        temp_file = record_cache + ".tmp"
+        try:
+            with open(temp_file, 'w', encoding='utf-8', newline='') as file:
+                for record_hash, record in entries.items():
+                    parsed = next(parse_records([record]), None) if record else None
+                    if self.is_superseded(record_hash, record, parsed, entries):
+                        continue
+                    qso_date = parsed.fields.get('QSO_DATE', '').strip() if parsed is not None else ""
+                    if qso_date != "" and qso_date < oldest:
+                        continue
+                    file.write(record_hash + ":" + ("" if hashes_only else record) + os.linesep)
+                    kept = kept + 1
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_file, record_cache)
+        except (IOError, OSError) as e:
+            raise io_error("Could not write record cache " + record_cache, e)
+        return CompactResult(record_cache, count, kept, size, os.path.getsize(record_cache))
+
+    def compact_record_db(self, hashes_only: bool, max_age: int) -> CompactResult:
+        # The age of an entry is the time of its upload. The entries are removed in one transaction,
+        # then the database is rebuilt by VACUUM, which replaces it as a whole as well.
+        record_cache_db = self.path(RECORD_CACHE_DB)
+        size = sum(os.path.getsize(path) for path in (record_cache_db, record_cache_db + "-wal")
+                   if os.path.isfile(path))
+        self.open_record_db()
+        try:
+            count = self.record_db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+            with self.record_db:
+                if max_age > 0:
+                    oldest = datetime.datetime.now() - datetime.timedelta(days=max_age)
+                    self.record_db.execute("DELETE FROM records WHERE timestamp < ?",
+                                           (oldest.isoformat(timespec='seconds'),))
+                # failed uploads don't count as cached, they can't supersede anything
+                hashes = {row[0] for row in self.record_db.execute("SELECT hash FROM records WHERE status != 'failed'")}
+                superseded = []
+                for record_hash, record in self.record_db.execute(
+                        "SELECT hash, record FROM records WHERE record IS NOT NULL").fetchall():
+                    if self.is_superseded(record_hash, record, next(parse_records([record]), None), hashes):
+                        superseded.append((record_hash,))
+                self.record_db.executemany("DELETE FROM records WHERE hash = ?", superseded)
+                if hashes_only:
+                    self.record_db.execute("UPDATE records SET record = NULL WHERE record IS NOT NULL")
+            self.record_db.execute("VACUUM")
+            kept = self.record_db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        except sqlite3.Error as e:
+            raise QrzError("Could not compact record cache database " + record_cache_db + ": " + str(e))
+        finally:
+            self.close_record_db()
+        return CompactResult(record_cache_db, count, kept, size, os.path.getsize(record_cache_db))
+
+    def compact_record_bin(self, max_age: int) -> CompactResult:
+        # The binary cache only keeps digests: the journal gets merged and digests found twice dropped.
+        # Without records and dates, neither superseded nor old entries can be told apart.
+        if max_age > 0:
+            LOGGER.warning("The binary record cache keeps no dates, no entries are dropped by their age")
+        record_cache_bin = self.path(RECORD_CACHE_BIN)
+        count = 0
+        size = 0
+        if os.path.isfile(record_cache_bin):
+            count = (os.path.getsize(record_cache_bin) - len(RECORD_BIN_MAGIC)) // 20
+            size = os.path.getsize(record_cache_bin)
+        if os.path.isfile(record_cache_bin + ".journal"):
+            count = count + os.path.getsize(record_cache_bin + ".journal") // 20
+            size = size + os.path.getsize(record_cache_bin + ".journal")
+        self.open_record_bin()
+        self.close_record_bin()
+        size_after = os.path.getsize(record_cache_bin)
+        return CompactResult(record_cache_bin, count, (size_after - len(RECORD_BIN_MAGIC)) // 20, size, size_after)
+
+    def prefetch_callsign_data(self, records) -> dict:
+        # resolving all callsigns of a batch which need an xml-lookup up front and in parallel,
+        # so the uploads don't have to wait for the lookups one by one
+        if not self.xml_lookups:
+            return {}
+
+        calls = {record.fields['CALL'].strip().upper() for record in records if needs_enrichment(record)}
+        if not calls:
+            return {}
+
+        LOGGER.debug("Prefetching callsign data for %s callsigns", str(len(calls)))
+        executor = ThreadPoolExecutor(max_workers=self.lookup_workers)
+        try:
+            return dict(zip(calls, executor.map(self.lookup_callsign, calls)))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def upload_batch(self, records: list, resolved: dict) -> list:
+        # Returns the records which could not be sent.
+        parked = []
+        if self.workers <= 1:
+            for record in records:
+                if not self.add_record(record, resolved):
+                    parked.append(record)
+            return parked
+
+        # The number of uploads in flight follows the rate limiter, up to the number of workers.
+        # Errors in a worker are re-raised here and stop the run.
+        LOGGER.debug("Uploading with %s workers", str(self.workers))
+        limiter = self.get_rate_limiter("api")
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending = {}
+        try:
+            for record in records:
+                while len(pending) >= limiter.concurrency:
+                    for future in wait(pending, return_when=FIRST_COMPLETED)[0]:
+                        if not future.result():
+                            parked.append(pending[future])
+                        del pending[future]
+                pending[executor.submit(self.add_record, record, resolved)] = record
+
+            for future in wait(pending)[0]:
+                if not future.result():
+                    parked.append(pending[future])
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        return parked
+
+    def park_records(self, records: list, attempts: dict) -> list:
+        # Records which could not be sent are retried later in the run, up to PARK_RETRIES times.
+        # Then they are given up, written into the failed records file and queued for a later run.
+        parked = []
+        for record in records:
+            attempts[record.raw] = attempts.get(record.raw, 0) + 1
+            if attempts[record.raw] <= PARK_RETRIES:
+                parked.append(record)
+                continue
+            LOGGER.error("Giving up on QSO with %s after %s attempts", record.fields.get('CALL', '').strip(),
+                         str(attempts[record.raw]))
+            self.add_failed_record(record.raw, "Could not be sent to qrz.com", record)
+            self.add_record_to_cache(record.raw, "failed", reason="Could not be sent to qrz.com",
+                                     key=self.record_fingerprint(record))
+
+        if parked:
+            LOGGER.warning("Parked %s records which could not be sent, will retry them later", str(len(parked)))
+            with self.lock:
+                self.parked = self.parked + len(parked)
+        return parked
+
+    def upload(self, records) -> UploadResult:
+        # The records - AdifRecords or ADIF text - are checked against the local cache and collected
+        # in batches. Per batch the xml-lookups are done first, then the records get uploaded.
+        # A QSO found several times in a batch, e.g. in two inputfiles, is only uploaded once.
+        # Records which could not be sent are added to the next batch.
+        processed, added, ignored, failed = self.processed, self.added, self.ignored, len(self.failed_records)
+        batch = []
+        queued = set()
+        parked = []
+        attempts = {}
+        for record in self.timed_iter("parse", parse_records(records)):
+            with self.timed("cache_lookup"):
+                cached = self.is_record_cached(record)
+            if cached:
+                pass
+            elif self.record_fingerprint(record) in queued:
+                LOGGER.debug("Record \"%s\" is already queued for upload", record.raw)
+                with self.lock:
+                    self.ignored = self.ignored + 1
+            else:
+                batch.append(record)
+                queued.add(self.record_fingerprint(record))
+            self.processed = self.processed + 1
+
+            if len(batch) >= UPLOAD_BATCH_SIZE:
+                batch = batch + parked
+                parked = self.park_records(self.upload_batch(batch, self.prefetch_callsign_data(batch)), attempts)
+                batch = []
+                queued = set()
+
+        # records still parked at the end are retried with an increasing delay
+        batch = batch + parked
+        delay = HTTP_BACKOFF
+        while batch:
+            parked = self.park_records(self.upload_batch(batch, self.prefetch_callsign_data(batch)), attempts)
+            if parked:
+                LOGGER.info("Waiting %s seconds before retrying", str(delay))
+                time.sleep(delay)
+                delay = delay * 2
+            batch = parked
+
+        return UploadResult(self.processed - processed, self.added - added, self.ignored - ignored,
+                            self.failed_records[failed:])
+
+    def fetch_logbook_page(self, after_logid: int) -> list:
+        # Fetches the QSOs of the qrz.com logbook with a logid of at least after_logid, up to
+        # SYNC_PAGE_SIZE per request. Returns the parsed records, an empty list at the end of the logbook.
+        payload = {'KEY': self.apikey, 'ACTION': 'FETCH',
+                   'OPTION': "TYPE:ADIF,MAX:" + str(SYNC_PAGE_SIZE) + ",AFTERLOGID:" + str(after_logid)}
+        response = self.post_with_retries("api", self.api_url, payload, "api_fetch")
+        if response is None:
+            raise QrzError("Could not fetch the logbook from " + self.api_url)
+
+        # the html-escaped ADIF is the last part of the response
+        head, _, adif = response.text.partition("ADIF=")
+        params = {}
+        for param in head.split('&'):
+            name, _, value = param.partition('=')
+            params[name] = value
+
+        if params.get('RESULT') != "OK":
+            reason = params.get('REASON', "No failure reasons provided by server")
+            if params.get('COUNT') == "0" or "no log entries" in reason.lower():
+                return []
+            raise QrzError("Fetching the logbook failed, server response was: \"" + reason + "\"")
+
+        return list(parse_adif(io.BytesIO(html.unescape(adif).encode('utf-8'))))
+
+    def sync(self, inputfiles: list = None) -> SyncResult:
+        # Fills the record cache with the QSOs of the qrz.com logbook, page by page.
+        # If inputfiles are given, the QSOs missing in them are appended to the first one.
+        # The logbook's records differ from the local ones, they can only be matched by QSO.
+        if self.fingerprint == "raw":
+            raise QrzError("The logbook can't be synced with raw fingerprints", 2)
+
+        local_qsos = None
+        missing = []
+        if inputfiles:
+            local_qsos = set()
+            for path in inputfiles:
+                for record in read_adif_records(path):
+                    local_qsos.add(self.record_fingerprint(record))
+
+        LOGGER.info("Fetching the logbook from %s", self.api_url)
+        pages = 0
+        fetched = 0
+        cached = self.cached
+        after_logid = 0
+        while True:
+            records = self.fetch_logbook_page(after_logid)
+            pages = pages + 1
+            for record in records:
+                key = self.record_fingerprint(record)
+                if not self.find_cached_record(key):
+                    self.add_record_to_cache(record.raw, logid=record.fields.get('APP_QRZLOG_LOGID'), key=key)
+                if local_qsos is not None and key not in local_qsos:
+                    local_qsos.add(key)
+                    missing.append(record.raw)
+            fetched = fetched + len(records)
+
+            # the next page starts behind the highest logid of this one
+            logids = [int(record.fields['APP_QRZLOG_LOGID']) for record in records
+                      if record.fields.get('APP_QRZLOG_LOGID', '').strip().isdigit()]
+            if len(records) < SYNC_PAGE_SIZE or not logids or max(logids) < after_logid:
+                break
+            after_logid = max(logids) + 1
+        self.synced = self.synced + fetched
+
+        LOGGER.info("Fetched %s QSOs from the logbook in %s requests, %s of them added to the record cache",
+                    str(fetched), str(pages), str(self.cached - cached))
+
+        if missing:
+            try:
+                with open(inputfiles[0], "a") as file:
+                    for record in missing:
+                        file.write(record + "\n")
+            except IOError as e:
+                raise io_error("Could not write into " + inputfiles[0], e)
+            LOGGER.info("Appended %s QSOs missing in the inputfiles to %s", str(len(missing)), inputfiles[0])
+
+        return SyncResult(fetched, self.cached - cached, len(missing))
+
+    def enrich_record(self, record: AdifRecord, resolved: dict = None) -> bytes:
+        adif = record_data(record)
+
+        if not self.xml_lookups:
+            LOGGER.debug("XMLKEY not set; missing qrz.com username/password. Will *not* try to enrich QSO grid data.")
+        else:
+            # enriching the record data with some values, e.g. adding an at least 6 chars long
+            # locator and - from the same lookup - the requested ENRICH_FIELDS missing in the record
+            if needs_enrichment(record):
+                call = record.fields['CALL'].strip().upper()
+                grid = record.fields.get('GRIDSQUARE', '').strip() or "(not provided)"
+                LOGGER.debug("Will try to enrich grid locator data for %s", call)
+                LOGGER.debug("Grid locator from wsjtx_log.adi: %s", grid)
+                if resolved is not None and call in resolved:
+                    userdata = resolved[call]
+                else:
+                    userdata = self.lookup_callsign(call)
+
+                fields = OrderedDict()
+                new_locator = fetch_locator(userdata)
+                if len(new_locator) >= 6:
+                    LOGGER.info("Updating %s locator from %s to %s", call, grid, new_locator)
+                    fields['GRIDSQUARE'] = new_locator
+                else:
+                    LOGGER.info("No precise locator data found; leaving locator untouched")
+                for name in self.enrich_fields:
+                    value = str(userdata.get(ENRICH_FIELDS[name]) or "").strip()
+                    if value != "" and record.fields.get(name, '').strip() == "":
+                        fields[name] = value
+
+                if fields:
+                    LOGGER.debug("Old record: %s", record.raw)
+                    adif = set_adif_fields(record, fields)
+                    LOGGER.debug("New record: %s", adif.decode('utf-8', errors='replace'))
+
+        return adif
+
+    def add_failed_record(self, record: str, reason: str = "", source: AdifRecord = None,
+                          permanent: bool = False) -> None:
+        # failed records are streamed into the failed records file of the run as they happen,
+        # so even a killed run leaves them behind for a retry. Those failing for a transient
+        # reason are put into the retry queue as well; the source record is queued, not the one sent.
+        retried = source is not None and self.queue_failed_record(source, reason, permanent)
+        with self.lock:
+            transient = not permanent and not is_permanent_failure(reason)
+            if source is not None and transient and not self.retry_queue_enabled:
+                self.unqueued_failures.append(source)
+            self.failed_records.append(record)
+            if retried:
+                # records of the retry queue are in the failed records file of an earlier run already
+                return
+            if self.failed_records_file is None:
+                self.failed_records_file = self.path(
+                    datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + "_failed_records.adi")
+            self.failed_records_streamed = self.failed_records_streamed + 1
+        self.write_async(self.failed_records_file, record + "\n", header="ADIF Export<eoh>\n")
+
+    def load_retry_queue(self) -> None:
+        self.retry_queue = {}
+        if not self.retry_queue_enabled:
+            return
+        retry_file = self.path(RETRY_QUEUE)
+        try:
+            with open(retry_file, 'r') as file:
+                self.retry_queue = json.load(file)
+        except IOError:
+            LOGGER.debug("Retry queue file does not exist")
+        except ValueError:
+            LOGGER.warning("Retry queue file %s is corrupted and will be replaced", retry_file)
+
+    def save_retry_queue(self) -> None:
+        # entries taken for a run which didn't get through are kept as they were
+        with self.lock:
+            if not self.retry_queue_changed:
+                return
+            retry_queue = dict(self.retry_taken)
+            retry_queue.update(self.retry_queue)
+            self.retry_queue_changed = bool(self.retry_taken)
+        retry_file = self.path(RETRY_QUEUE)
+        temp_file = retry_file + ".tmp"
+        try:
+            with open(temp_file, "w") as file:
+                json.dump(retry_queue, file, indent=1)
+            os.replace(temp_file, retry_file)
+        except (IOError, OSError) as e:
+            LOGGER.error("Could not write retry queue file %s", retry_file)
             LOGGER.error("I/O error({0}): {1}".format(e.errno, e.strerror))
-            exit(1)
 
+    def has_due_retries(self) -> bool:
+        if self.retry_queue is None:
+            self.load_retry_queue()
+        now = time.time()
+        return any(entry['next_attempt'] <= now for entry in self.retry_queue.values())
+
+    def take_due_retries(self):
+        # Yields the records of the retry queue whose next attempt is due. They are taken out of
+        # the queue; queue_failed_record() puts those failing again back with one more attempt.
+        if self.retry_queue is None:
+            self.load_retry_queue()
+        now = time.time()
+        due = [record_hash for record_hash, entry in self.retry_queue.items() if entry['next_attempt'] <= now]
+        if due:
+            LOGGER.info("Retrying %s records of the retry queue", str(len(due)))
+        for record_hash in due:
+            with self.lock:
+                entry = self.retry_queue.pop(record_hash)
+                self.retry_taken[record_hash] = entry
+                self.retry_queue_changed = True
+                self.retried = self.retried + 1
+            yield entry['record']
+
+    def queue_failed_record(self, record: AdifRecord, reason: str, permanent: bool = False) -> bool:
+        # Returns True if the record is known to the retry queue - taken for this run, or still
+        # waiting there when it was read again from the inputfiles, e.g. with --no-checkpoint or -d.
+        if not self.retry_queue_enabled:
+            return False
+        call = record.fields.get('CALL', '').strip()
+        record_hash = sha1(self.record_fingerprint(record).encode('utf-8')).hexdigest()
+        now = time.time()
+        with self.lock:
+            if self.retry_queue is None:
+                self.load_retry_queue()
+            entry = self.retry_taken.pop(record_hash, None)
+            if entry is None:
+                # the attempts go on counting, the backoff isn't started over
+                entry = self.retry_queue.pop(record_hash, None)
+                self.retry_queue_changed = self.retry_queue_changed or entry is not None
+            if permanent or is_permanent_failure(reason):
+                if entry is not None:
+                    LOGGER.error("Removed QSO with %s from the retry queue, it was rejected for good", call)
+                return entry is not None
+
+            attempts = entry['attempts'] + 1 if entry is not None else 1
+            self.retry_queue_changed = True
+            if attempts > RETRY_ATTEMPTS:
+                LOGGER.error("Giving up on QSO with %s after %s retries, it's left in the failed records file", call,
+                             str(entry['attempts']))
+                return True
+            next_attempt = now + min(RETRY_BACKOFF * 2 ** (attempts - 1), RETRY_MAX_BACKOFF)
+            self.retry_queue[record_hash] = {
+                'record': record.raw,
+                'reason': reason,
+                'attempts': attempts,
+                'first_failed': entry['first_failed'] if entry is not None else now,
+                'last_failed': now,
+                'next_attempt': next_attempt,
+            }
+        LOGGER.info("Will retry the QSO with %s in a run after %s", call,
+                    datetime.datetime.fromtimestamp(next_attempt).isoformat(sep=" ", timespec='seconds'))
+        return entry is not None
+
+    def write_failed_records(self) -> None:
+        # waits until the failed records and the record cache entries are on disk
+        self.flush_writes()
+        failed_records = self.failed_records_streamed - self.failed_records_written
+        if failed_records == 0:
+            return
+        self.failed_records_written = self.failed_records_written + failed_records
+        LOGGER.info("Written %s failed records into file %s", str(failed_records), self.failed_records_file)
+
+    def flush(self) -> None:
+        self.save_callsign_cache()
+        self.save_retry_queue()
+        with self.lock:
+            if self.record_db is not None and self.record_db_pending > 0:
+                self.record_db.commit()
+                self.record_db_pending = 0
+
+    def close(self) -> None:
+        # everything is closed, even if writing the pending records fails
+        try:
+            self.close_writer()
+        finally:
+            self.close_record_bin()
+            self.close_record_db()
+            self.save_callsign_cache()
+            self.save_retry_queue()
+            if self.http_session is not None:
+                self.http_session.close()
+                self.http_session = None
+
+    def load_checkpoints(self) -> None:
+        self.checkpoints = {}
+        if not self.checkpoints_enabled:
+            return
+        checkpoint_file = self.path(CHECKPOINT_FILE)
+        try:
+            with open(checkpoint_file, 'r') as file:
+                self.checkpoints = json.load(file)
+        except IOError:
+            LOGGER.debug("Checkpoint file does not exist")
+        except ValueError:
+            LOGGER.warning("Checkpoint file %s is corrupted, reading inputfiles from the beginning", checkpoint_file)
+
+    def save_checkpoints(self) -> None:
+        if not self.checkpoints_enabled or self.checkpoints is None:
+            return
+        checkpoint_file = self.path(CHECKPOINT_FILE)
+        temp_file = checkpoint_file + ".tmp"
+        try:
+            with open(temp_file, "w") as file:
+                json.dump(self.checkpoints, file, indent=1)
+            os.replace(temp_file, checkpoint_file)
+        except (IOError, OSError) as e:
+            LOGGER.error("Could not write checkpoint file %s", checkpoint_file)
+            LOGGER.error("I/O error({0}): {1}".format(e.errno, e.strerror))
 
-def strip_quotes(value):
-    if value.startswith('"') and value.endswith('"'):
-        return value[1:-1]
-    return value
+    def get_checkpoint_offset(self, path: str) -> int:
+        # The checkpoint of an inputfile is only used if it is still the same file (inode),
+        # it wasn't truncated and the last processed record is still found right before
+        # the checkpoint's offset. Otherwise the file is read from the beginning.
+        if self.checkpoints is None:
+            self.load_checkpoints()
 
+        checkpoint = self.checkpoints.get(os.path.abspath(path))
+        if checkpoint is None:
+            return 0
 
-def print_help():
+        try:
+            stat = os.stat(path)
+            if stat.st_ino != checkpoint['inode'] or stat.st_size < checkpoint['offset']:
+                LOGGER.info("The source file %s was truncated or replaced, reading it from the beginning", path)
+                return 0
+            with open(path, 'rb') as file:
+                file.seek(checkpoint['offset'] - checkpoint['record_length'])
+                last_record = file.read(checkpoint['record_length'])
+        except (OSError, KeyError, TypeError, ValueError):
+            LOGGER.debug("Unusable checkpoint for %s", path)
+            return 0
+
+        if sha1(last_record).hexdigest() != checkpoint['record_hash']:
+            LOGGER.info("The source file %s was modified, reading it from the beginning", path)
+            return 0
+
+        LOGGER.debug("Resuming %s at offset %s", path, str(checkpoint['offset']))
+        return checkpoint['offset']
+
+    def set_checkpoint(self, path: str, record: AdifRecord) -> None:
+        if self.checkpoints is None:
+            self.load_checkpoints()
+
+        if record is None:
+            self.checkpoints.pop(os.path.abspath(path), None)
+            return
+
+        stat = os.stat(path)
+        raw = record_data(record)
+        self.checkpoints[os.path.abspath(path)] = {
+            'inode': stat.st_ino,
+            'size': stat.st_size,
+            'offset': record.offset,
+            'record_length': len(raw),
+            'record_hash': sha1(raw).hexdigest(),
+        }
+
+    def set_checkpoint_before(self, paths: list, record: AdifRecord) -> None:
+        # Moves the checkpoint of the inputfile the record was read from back in front of the record.
+        # The position is identified by the bytes before it - as many as the record has - instead of the last record.
+        if self.checkpoints is None:
+            self.load_checkpoints()
+        data = record_data(record)
+        start = record.offset - len(data)
+        context_start = max(0, start - len(data))
+        for path in paths:
+            checkpoint = self.checkpoints.get(os.path.abspath(path))
+            if checkpoint is None or checkpoint['offset'] <= start:
+                continue
+            try:
+                with open(path, 'rb') as file:
+                    file.seek(context_start)
+                    context = file.read(start - context_start)
+                    if file.read(len(data)) != data:
+                        continue
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            LOGGER.debug("Checkpoint of %s set in front of the failed QSO with %s", path,
+                         record.fields.get('CALL', '').strip())
+            if start == 0:
+                del self.checkpoints[os.path.abspath(path)]
+            else:
+                self.checkpoints[os.path.abspath(path)] = {
+                    'inode': stat.st_ino,
+                    'size': stat.st_size,
+                    'offset': start,
+                    'record_length': len(context),
+                    'record_hash': sha1(context).hexdigest(),
+                }
+            return
+
+    def upload_files(self, offsets: dict) -> UploadResult:
+        # Uploads the records of the inputfiles (path -> offset to start at) and remembers
+        # the last record of every file in the checkpoints. With delete the files get emptied,
+        # but only if the failed records were written. The records of the retry queue which
+        # are due go first.
+        last_records = {}
+        result = self.upload(itertools.chain(self.take_due_retries(), read_inputfiles(offsets, last_records)))
+
+        # the retried records still taken were added, found in the cache or rejected for good
+        with self.lock:
+            self.retry_taken = {}
+
+        # now, if there are any failed records - make sure they are written into a separate file
+        try:
+            self.write_failed_records()
+        except QrzError:
+            if self.delete:
+                LOGGER.warning("Will *not* empty %s due to error below", ", ".join(offsets))
+            raise
+
+        # if succeeded writing down failed records - empty the source files, if requested
+        if self.delete:
+            for path in offsets:
+                try:
+                    with open(path, "w") as file:
+                        file.write("ADIF Export<eoh>\n")
+                except IOError as e:
+                    raise io_error("Could not empty " + path, e)
+                LOGGER.info("Emptied the source file %s", path)
+                last_records[path] = None
+
+        for path, last_record in last_records.items():
+            self.set_checkpoint(path, last_record)
+        # records failed for a transient reason are read again by the next run, unless the retry queue has them;
+        # the records uploaded behind them are skipped by the record cache then
+        with self.lock:
+            unqueued_failures, self.unqueued_failures = self.unqueued_failures, []
+        for record in unqueued_failures:
+            self.set_checkpoint_before(list(last_records), record)
+        self.save_checkpoints()
+        self.save_retry_queue()
+        return result
+
+    def watch(self, inputfiles: list, interval: float = WATCH_INTERVAL, callback=None) -> None:
+        # Keeps running and uploads records as they get appended to the inputfiles, until interrupted.
+        # The files are polled for changes; only the data behind the last complete record is parsed.
+        # If a file is truncated or replaced, it is read again from the beginning -
+        # already uploaded records are skipped by the record cache.
+        # Due records of the retry queue are uploaded along the way.
+        # callback is called after every pass which uploaded something.
+        if self.delete:
+            raise QrzError("Inputfiles can't be emptied while watching them", 2)
+
+        LOGGER.info("Watching %s for new records, press Ctrl-C to stop", ", ".join(inputfiles))
+        last_seen = {}
+        try:
+            while True:
+                offsets = {}
+                for path in inputfiles:
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if (stat.st_ino, stat.st_size) != last_seen.get(path):
+                        last_seen[path] = (stat.st_ino, stat.st_size)
+                        offsets[path] = self.get_checkpoint_offset(path)
+
+                if offsets or self.has_due_retries():
+                    self.upload_files(offsets)
+                    self.flush()
+                    if callback is not None:
+                        callback()
+
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            LOGGER.info("Stopped watching %s", ", ".join(inputfiles))
+
+
+def print_help(exitcode: int = 0):
     print("")
     print(PROGRAM_NAME + " v" + PROGRAM_VERSION + " ( " + PROGRAM_URL + " )")
     print("")
@@ -346,15 +2284,44 @@ def print_help():
     print(" -x  --xmllookups        make grid data lookups over qrz.com's xml-interface, default: no")
     print(" -u  --username          qrz.com username for xml-lookups")
     print(" -p  --password          qrz.com password for xml-lookups")
-    print(" -i  --inputfile         setting inputfile, default: wsjtx_log.adi")
+    print(" -i  --inputfile         setting inputfile, a directory or a glob pattern; can be given several times, default: wsjtx_log.adi")
     print(
         " -e  --enable-idle-log   log message \"The source file is empty; doing nothing\" on every run if logfile is empty")
     print(" -l  --logfile           setting logfile, default: " + os.path.basename(__file__).split(".")[0] + ".log")
     print(" -d  --delete            empty the inputfile after import, default: no")
+    print("     --workers           number of parallel uploads, default: 1")
+    print("     --lookup-workers    number of parallel xml-lookups, default: " + str(LOOKUP_WORKERS))
+    print("     --enrich-fields     with -x: comma separated fields to add from the xml-lookups if missing, " + ", ".join(ENRICH_FIELDS) + ", default: none")
+    print("     --cache-backend     record cache backend, \"text\" (" + RECORD_CACHE + "), \"sqlite\" (" + RECORD_CACHE_DB + ") or \"binary\" (" + RECORD_CACHE_BIN + "), default: text")
+    print("     --fingerprint       identify cached records by their QSO (call, date, time, band, mode, station) - \"qso\" - or by their raw text - \"raw\", default: qso")
+    print("     --timeout           timeout in seconds for qrz.com requests, default: " + str(HTTP_TIMEOUT))
+    print("     --retries           retries of qrz.com requests on server errors, default: " + str(HTTP_RETRIES))
+    print("     --max-rate          max. number of records uploaded per second, lowered automatically while qrz.com is throttling, default: unlimited")
+    print("     --pool-size         max. number of connections to qrz.com, default: number of workers")
+    print("     --callsign-cache-ttl    days to keep xml-lookup results in " + CALLSIGN_CACHE + ", 0 disables the cache, default: " + str(CALLSIGN_CACHE_TTL))
+    print("     --callsign-cache-size   max. number of callsigns kept in " + CALLSIGN_CACHE + ", default: " + str(CALLSIGN_CACHE_SIZE))
+    print("     --no-checkpoint     always read the whole inputfile instead of continuing behind the last processed record")
+    print("     --no-retry-queue    don't retry records which failed for a transient reason in later runs")
+    print("     --sync-from-qrz     fill the record cache with the QSOs of the qrz.com logbook and exit")
+    print("     --sync-merge        with --sync-from-qrz: append QSOs missing in the inputfiles to the first inputfile")
+    print("     --compact-cache     remove duplicate and superseded entries from the record cache and exit")
+    print("     --compact-hashes-only   with --compact-cache: keep only the hashes, not the records")
+    print("     --compact-max-age   with --compact-cache: drop entries of QSOs older than the given number of days")
+    print("     --watch             keep running and upload new records as they get appended to the inputfile")
+    print("     --watch-interval    seconds between checks of the inputfile in watch mode, default: " + str(WATCH_INTERVAL))
+    print("     --stats-json        write run statistics and per-phase timings as json into the given file")
+    print("     --profile           profile the run, written into " + PROFILE_FILE)
     print("     --debug             enable debugging output")
     print(" -v  --version           print program version and exit")
     print("")
-    exit(0)
+    exit(exitcode)
+
+
+def usage_error(message: str, *args):
+    # wrong options, printed with the usage - the exitcode is 2
+    print("")
+    LOGGER.error(message, *args)
+    print_help(2)
 
 
 def print_version():
@@ -364,230 +2331,390 @@ def print_version():
     exit(0)
 
 
-def enrich_record(record: str) -> str:
-    if XMLKEY in ('', 'QRZ_COM_XMLKEY'):
-        LOGGER.debug("XMLKEY not set; missing qrz.com username/password. Will *not* try to enrich QSO grid data.")
-    else:
-        # enriching the record data with some values,
-        # e.g. adding an at least 6 chars long locator
+def write_stats_json(path: str, uploader: Uploader, inputfiles: list) -> None:
+    stats = {
+        'program': PROGRAM_NAME,
+        'version': PROGRAM_VERSION,
+        'inputfiles': inputfiles,
+        'started': datetime.datetime.fromtimestamp(RUN_START).isoformat(timespec='seconds'),
+        'duration': time.time() - RUN_START,
+        'exitcode': EXITCODE or uploader.exitcode,
+    }
+    stats.update(uploader.stats())
+
+    temp_file = path + ".tmp"
+    try:
+        with open(temp_file, "w") as file:
+            json.dump(stats, file, indent=1)
+        os.replace(temp_file, path)
+    except (IOError, OSError) as e:
+        LOGGER.error("Could not write statistics into %s", path)
+        LOGGER.error("I/O error({0}): {1}".format(e.errno, e.strerror))
 
-        data = {}
 
-        # splitting fields
-        for entry in record.split('<'):
-            if entry == "" or entry.startswith("eor>") or entry.startswith("EOR>"):
-                LOGGER.debug("Ignoring field: %s", entry)
-            else:
-                # trying to split the line
-                key = ""
-                try:
-                    key = entry.split(':')[0].upper()
-                except ValueError:
-                    LOGGER.debug("Failed to extract key from \"%s\"", entry)
-
-                # ignoring keys with weird stuff in names
-                # the only permitted chars are "[A-Z0-9_]", thus "\w"
-                # So, if anything else is present - it can't be right, ignoring the key then
-                if re.match(r'[^\w]+', key):
-                    LOGGER.debug("Ignoring key: %s", key)
-                else:
-                    value = ((entry.split('>')[1]).strip()).upper()
-                    data[key] = str(value)
-
-        if len(data.get('GRIDSQUARE', '')) <= 4:
-            if data.get('GRIDSQUARE', '') == "":
-                data['GRIDSQUARE'] = "(not provided)"
-            LOGGER.debug("Will try to enrich grid locator data for %s", data['CALL'])
-            LOGGER.debug("Grid locator from wsjtx_log.adi: %s", data['GRIDSQUARE'])
-            fetch_callsign_data(data['CALL'])
-
-            new_locator = fetch_locator()
-            if len(new_locator) >= 6:
-                LOGGER.info("Updating %s locator from %s to %s", data['CALL'], data['GRIDSQUARE'], new_locator)
-                data['GRIDSQUARE'] = new_locator
-                LOGGER.debug("Old record: %s", record)
-                # constructing back the ADIF record since data was modified
-                record = ""
-                for element in data:
-                    record += "<" + element.lower() + ":" + str(len(data[element])) + ">" + str(data[element]) + " "
-                record += " <eor>"
-                LOGGER.debug("New record: %s", record)
-            else:
-                LOGGER.info("No precise locator data found; leaving record untouched")
+def write_profile(profiler) -> None:
+    import pstats
+
+    profiler.disable()
+    profiler.dump_stats(PROFILE_FILE)
+    LOGGER.info("Written profile into %s", PROFILE_FILE)
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+
+
+def log_to_file(logfile: str) -> None:
+    # create the default/requested logfile
+    if logfile == "null":
+        return
+
+    import logging.handlers
+
+    file_handler = logging.FileHandler(logfile)
+    file_handler.setFormatter(FORMATTER)
+    # written on a background thread, logging doesn't hold up the uploads
+    log_queue = queue.Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    LOGGER.addHandler(logging.handlers.QueueHandler(log_queue))
 
-    return record
+
+def run(uploader: Uploader, inputfiles: list, logfile: str, sync_flag: bool, sync_merge: bool, watch_flag: bool,
+        watch_interval: float, write_idle_log: bool, stats_json: str) -> None:
+    if sync_flag:
+        log_to_file(logfile)
+        uploader.sync(inputfiles if sync_merge else None)
+        return
+
+    if watch_flag:
+        log_to_file(logfile)
+
+        # the statistics are updated after every pass
+        def write_stats():
+            write_stats_json(stats_json, uploader, inputfiles)
+
+        uploader.watch(inputfiles, watch_interval, write_stats if stats_json is not None else None)
+        uploader.log_statistics()
+        return
+
+    # continue behind the last record processed in a previous run,
+    # unless the whole file gets imported and emptied anyway
+    offsets = {}
+    for path in inputfiles:
+        offsets[path] = 0 if uploader.delete else uploader.get_checkpoint_offset(path)
+    resumed = any(offsets.values())
+
+    # inputfiles containing no (new) records, e.g. only the header, are skipped
+    for path in inputfiles:
+        if not has_records(path, offsets[path]):
+            LOGGER.debug("The source file %s has no new records", path)
+            del offsets[path]
+
+    # if none of them has records and no retry is due, then there's nothing to do
+    if not offsets and not uploader.has_due_retries():
+        if len(inputfiles) > 1:
+            idle_message = "The source files %s have no new records; nothing to do"
+        elif resumed:
+            idle_message = "The source file %s has no new records; nothing to do"
+        else:
+            idle_message = "The source file %s is empty; nothing to do"
+        # the logfile is only opened when there's something to do or the idle message is wanted
+        if write_idle_log:
+            log_to_file(logfile)
+        LOGGER.info(idle_message, ", ".join(inputfiles))
+        return
+
+    # if they do contain entries - per record - add
+    log_to_file(logfile)
+    uploader.upload_files(offsets)
+    uploader.log_statistics()
+
+
+def compact_cache(uploader: Uploader, hashes_only: bool, max_age: int) -> None:
+    load_before, lookup_before = uploader.time_record_cache()
+    result = uploader.compact_record_cache(hashes_only, max_age)
+    load_after, lookup_after = uploader.time_record_cache()
+
+    LOGGER.info("Compacted record cache %s from %s entries (%s bytes) to %s entries (%s bytes)", result.path,
+                str(result.entries_before), str(result.size_before), str(result.entries_after), str(result.size_after))
+    LOGGER.info("Loading the record cache took %.1f ms before and takes %.1f ms now, a lookup %.1f us before "
+                "and %.1f us now", load_before * 1000, load_after * 1000, lookup_before * 1000000,
+                lookup_after * 1000000)
 
 
 def main():
-    global LOGFILE, DEBUG_FLAG, EXITCODE
-    global APIKEY, APIURL
-    global XMLKEY, XML_USERNAME, XML_PASSWORD, XML_LOOKUPS
-    global INPUTFILE
-    global DELETE_FLAG
-    global WRITE_IDLE_LOG
-    global PROCESSED_RECORDS
+    global EXITCODE
+
+    LOGGER.addHandler(STDOUT_HANDLER)
+
+    apikey = "QRZ_COM_APIKEY"
+    api_url = APIURL
+    xml_url = XMLURL
+    xml_username = "QRZ_COM_USERNAME"
+    xml_password = "QRZ_COM_PASSWORD"
+    xml_lookups = False
+    logfile = LOGFILE
+    inputfiles = []
+    workers = WORKERS
+    lookup_workers = LOOKUP_WORKERS
+    max_rate = 0.0
+    callsign_cache_ttl = CALLSIGN_CACHE_TTL
+    callsign_cache_size = CALLSIGN_CACHE_SIZE
+    http_timeout = HTTP_TIMEOUT
+    http_retries = HTTP_RETRIES
+    http_pool_size = 0
+    cache_backend = "text"
+    fingerprint = "qso"
+    watch_flag = False
+    watch_interval = WATCH_INTERVAL
+    checkpoint_flag = True
+    retry_queue_flag = True
+    sync_flag = False
+    sync_merge = False
+    compact_flag = False
+    compact_hashes_only = False
+    compact_max_age = 0
+    enrich_fields = []
+    stats_json = None
+    profile_flag = False
+    delete_flag = False
+    write_idle_log = False
+    debug_flag = False
 
     # grab variables if present in environment
     if 'APIKEY' in os.environ:
-        APIKEY = strip_quotes(os.environ['APIKEY'])
+        apikey = strip_quotes(os.environ['APIKEY'])
 
     if 'QRZ_COM_USERNAME' in os.environ:
-        XML_USERNAME = strip_quotes(os.environ['QRZ_COM_USERNAME'])
+        xml_username = strip_quotes(os.environ['QRZ_COM_USERNAME'])
 
     if 'QRZ_COM_PASSWORD' in os.environ:
-        XML_PASSWORD = strip_quotes(os.environ['QRZ_COM_PASSWORD'])
+        xml_password = strip_quotes(os.environ['QRZ_COM_PASSWORD'])
+
+    # alternative qrz.com endpoints, e.g. a local stub for testing
+    if 'QRZ_API_URL' in os.environ:
+        api_url = strip_quotes(os.environ['QRZ_API_URL'])
+
+    if 'QRZ_XML_URL' in os.environ:
+        xml_url = strip_quotes(os.environ['QRZ_XML_URL'])
 
     # grab opts
     options, rest = getopt.gnu_getopt(sys.argv[1:],
                                       'l:a:hedi:xu:p:v',
                                       ['logfile=', 'apikey=', 'help', 'idle_log', 'delete', 'inputfile=',
-                                       'xmllookups', 'username=', 'password=', 'debug', 'version'])
+                                       'xmllookups', 'username=', 'password=', 'debug', 'version', 'workers=', 'lookup-workers=',
+                                       'callsign-cache-ttl=', 'callsign-cache-size=', 'timeout=', 'retries=',
+                                       'pool-size=', 'max-rate=', 'cache-backend=', 'fingerprint=', 'watch', 'watch-interval=',
+                                       'no-checkpoint', 'stats-json=', 'profile', 'sync-from-qrz', 'sync-merge',
+                                       'compact-cache', 'compact-hashes-only', 'compact-max-age=', 'enrich-fields=',
+                                       'no-retry-queue'])
 
     # check opts
     for opt, arg in options:
         if opt in ('-l', '--logfile'):
-            LOGFILE = arg
+            logfile = arg
         elif opt in ('-a', '--apikey'):
-            APIKEY = arg
+            apikey = arg
         elif opt in ('-x', '--xmllookups'):
-            XML_LOOKUPS = True
+            xml_lookups = True
         elif opt in ('-u', '--username'):
-            XML_USERNAME = arg
+            xml_username = arg
         elif opt in ('-p', '--password'):
-            XML_PASSWORD = arg
+            xml_password = arg
         elif opt in ('-d', '--delete'):
-            DELETE_FLAG = True
+            delete_flag = True
         elif opt in ('-e', '--enable-idle-log'):
-            WRITE_IDLE_LOG = True
+            write_idle_log = True
         elif opt in '--debug':
-            DEBUG_FLAG = True
+            debug_flag = True
         elif opt in ('-h', '--help'):
             print_help()
         elif opt in ('-v', '--version'):
             print_version()
         elif opt in ('-i', '--inputfile'):
-            INPUTFILE = arg
-
-    if DEBUG_FLAG:
+            inputfiles.append(arg)
+        elif opt == '--workers':
+            try:
+                workers = int(arg)
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                usage_error("The number of workers has to be a positive number, got \"%s\"", arg)
+        elif opt == '--lookup-workers':
+            try:
+                lookup_workers = int(arg)
+            except ValueError:
+                lookup_workers = 0
+            if lookup_workers < 1:
+                usage_error("The number of lookup workers has to be a positive number, got \"%s\"", arg)
+        elif opt == '--cache-backend':
+            if arg not in CACHE_BACKENDS:
+                usage_error("Unknown cache backend \"%s\", supported are \"text\", \"sqlite\" and \"binary\"", arg)
+            cache_backend = arg
+        elif opt == '--fingerprint':
+            if arg not in FINGERPRINTS:
+                usage_error("Unknown fingerprint \"%s\", supported are \"qso\" and \"raw\"", arg)
+            fingerprint = arg
+        elif opt == '--stats-json':
+            stats_json = arg
+        elif opt == '--profile':
+            profile_flag = True
+        elif opt == '--no-checkpoint':
+            checkpoint_flag = False
+        elif opt == '--no-retry-queue':
+            retry_queue_flag = False
+        elif opt == '--sync-from-qrz':
+            sync_flag = True
+        elif opt == '--sync-merge':
+            sync_merge = True
+        elif opt == '--enrich-fields':
+            enrich_fields = [name.strip().upper() for name in arg.split(',') if name.strip() != ""]
+            for name in enrich_fields:
+                if name not in ENRICH_FIELDS:
+                    usage_error("Unknown enrich field \"%s\", supported are %s", name, ", ".join(ENRICH_FIELDS))
+        elif opt == '--compact-cache':
+            compact_flag = True
+        elif opt == '--compact-hashes-only':
+            compact_hashes_only = True
+        elif opt == '--compact-max-age':
+            try:
+                compact_max_age = int(arg)
+            except ValueError:
+                compact_max_age = 0
+            if compact_max_age < 1:
+                usage_error("The max. age of record cache entries has to be a positive number of days, got \"%s\"", arg)
+        elif opt == '--watch':
+            watch_flag = True
+        elif opt == '--watch-interval':
+            try:
+                watch_interval = float(arg)
+            except ValueError:
+                watch_interval = 0
+            if watch_interval <= 0:
+                usage_error("The watch interval has to be a positive number of seconds, got \"%s\"", arg)
+        elif opt == '--timeout':
+            try:
+                http_timeout = float(arg)
+            except ValueError:
+                http_timeout = 0
+            if http_timeout <= 0:
+                usage_error("The timeout has to be a positive number of seconds, got \"%s\"", arg)
+        elif opt == '--retries':
+            try:
+                http_retries = int(arg)
+            except ValueError:
+                http_retries = -1
+            if http_retries < 0:
+                usage_error("The number of retries can't be negative, got \"%s\"", arg)
+        elif opt == '--max-rate':
+            try:
+                max_rate = float(arg)
+            except ValueError:
+                max_rate = 0
+            if max_rate <= 0:
+                usage_error("The max. rate has to be a positive number of records per second, got \"%s\"", arg)
+        elif opt == '--pool-size':
+            try:
+                http_pool_size = int(arg)
+            except ValueError:
+                http_pool_size = 0
+            if http_pool_size < 1:
+                usage_error("The pool size has to be a positive number, got \"%s\"", arg)
+        elif opt == '--callsign-cache-ttl':
+            try:
+                callsign_cache_ttl = float(arg)
+            except ValueError:
+                usage_error("The callsign cache ttl has to be a number of days, got \"%s\"", arg)
+        elif opt == '--callsign-cache-size':
+            try:
+                callsign_cache_size = int(arg)
+            except ValueError:
+                callsign_cache_size = 0
+            if callsign_cache_size < 1:
+                usage_error("The callsign cache size has to be a positive number, got \"%s\"", arg)
+
+    # further arguments are taken as inputfiles too, e.g. from "-i *.adi" expanded by the shell
+    inputfiles = inputfiles + rest
+    if not inputfiles:
+        inputfiles = [INPUTFILE]
+
+    if debug_flag:
         LOGGER.setLevel(logging.DEBUG)
     else:
         LOGGER.setLevel(logging.INFO)
 
     # now check whether everything needed is given - at least apikey & inputfile
-    # must be present
-    if APIKEY in ('', 'QRZ_COM_APIKEY'):
-        print("")
-        LOGGER.error(
+    # must be present, the cache compaction works offline
+    if apikey in ('', 'QRZ_COM_APIKEY') and not compact_flag:
+        usage_error(
             "API key for qrz.com not specified. Please use either \"-a\" key or set environment variable \"APIKEY\".")
-        print_help()
-        exit(2)
+
+    # emptying the inputfile while watching it would race with the logging program
+    if watch_flag and delete_flag:
+        usage_error("The options \"--watch\" and \"-d\" can't be combined.")
+
+    # the logbook of qrz.com is matched by QSO, its records differ from the local ones
+    if sync_flag and fingerprint == "raw":
+        usage_error("The option \"--sync-from-qrz\" can't be combined with \"--fingerprint raw\".")
+
+    if sync_merge and not sync_flag:
+        usage_error("The option \"--sync-merge\" requires \"--sync-from-qrz\".")
+
+    if compact_flag and (sync_flag or watch_flag):
+        usage_error("The option \"--compact-cache\" can't be combined with \"--sync-from-qrz\" or \"--watch\".")
+
+    if (compact_hashes_only or compact_max_age) and not compact_flag:
+        usage_error("The options \"--compact-hashes-only\" and \"--compact-max-age\" require \"--compact-cache\".")
+
+    if enrich_fields and not xml_lookups:
+        usage_error("The option \"--enrich-fields\" requires \"-x\".")
 
     # if xml_lookups are requested, username and password must be provided
-    if XML_LOOKUPS:
-        if XML_USERNAME in ('', 'QRZ_COM_USERNAME'):
-            print("")
-            LOGGER.error(
+    xml_lookups = xml_lookups and not sync_flag
+    if xml_lookups:
+        if xml_username in ('', 'QRZ_COM_USERNAME'):
+            usage_error(
                 "Username for qrz.com not specified. Please use either \"-u\" key or set environment variable \"QRZ_COM_USERNAME\".")
-            print_help()
-            exit(2)
 
-        if XML_PASSWORD in ('', 'QRZ_COM_PASSWORD'):
-            print("")
-            LOGGER.error(
+        if xml_password in ('', 'QRZ_COM_PASSWORD'):
+            usage_error(
                 "Password for qrz.com not specified. Please use either \"-p\" key or set environment variable \"QRZ_COM_PASSWORD\".")
-            print_help()
-            exit(2)
 
-        get_xml_session_key()
+    uploader = Uploader(apikey, api_url=api_url, xml_lookups=xml_lookups, username=xml_username,
+                        password=xml_password, xml_key=os.environ.get('XMLKEY') if xml_lookups else None,
+                        xml_url=xml_url, workers=workers, lookup_workers=lookup_workers, max_rate=max_rate,
+                        timeout=http_timeout, retries=http_retries, pool_size=http_pool_size,
+                        cache_backend=cache_backend, fingerprint=fingerprint, callsign_cache_ttl=callsign_cache_ttl,
+                        callsign_cache_size=callsign_cache_size, checkpoints=checkpoint_flag, delete=delete_flag,
+                        enrich_fields=enrich_fields, retry_queue=retry_queue_flag)
 
-    # check whether the default/specified inputfile is present
-    if not os.path.isfile(INPUTFILE):
-        LOGGER.error("The inputfile %s does not exist", INPUTFILE)
-        exit(3)
+    # both are written on any exit from here on
+    if stats_json is not None:
+        atexit.register(write_stats_json, stats_json, uploader, inputfiles)
+    if profile_flag:
+        import cProfile
 
-    # create the default/requested logfile
-    if LOGFILE != "null":
-        file_handler = logging.FileHandler(LOGFILE)
-        file_handler.setFormatter(FORMATTER)
-        logging.getLogger().addHandler(file_handler)
-
-    with open(INPUTFILE):
-        lines = [line.rstrip('\n') for line in open(INPUTFILE)]
-
-    # if the inputfile contains only the header, then there's nothing to do
-    if len(lines) < 1 or (len(lines) == 1 and lines[0].endswith("ADIF Export<eoh>")):
-        if WRITE_IDLE_LOG:
-            LOGGER.info("The source file %s is empty; nothing to do", INPUTFILE)
-        else:
-            LOGGER.handlers = []
-            LOGGER.addHandler(STDOUT_HANDLER)
-            LOGGER.info("The source file %s is empty; nothing to do", INPUTFILE)
-        exit(0)
-
-    # TODO: add here the new method how to parse data.
-    # if it does contain entries - per record - add
-    for line in lines:
-        if line.endswith("<EOR>") or line.endswith("<eor>"):
-            # check local records cache and if the record is not present in it - add the record
-            if not find_cached_record(line):
-                add_record(line)
-            PROCESSED_RECORDS = PROCESSED_RECORDS + 1
-
-    # now, if there are any failed records - write them into a separate file
-    if len(FAILED_RECORDS) > 0:
-        failed_records_file = datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + "_failed_records.adi"
-        try:
-            file = open(failed_records_file, "w")
-            file.write("ADIF Export<eoh>\n")
-            for failed in FAILED_RECORDS:
-                file.write(failed + "\n")
-            file.close()
-        except IOError as e:
-            LOGGER.error("Could not write failed records into %s", failed_records_file)
-            LOGGER.error("I/O error({0}): {1}".format(e.errno, e.strerror))
-            if DELETE_FLAG:
-                LOGGER.warning("Will *not* empty %s due to error above", INPUTFILE)
-            # and exit NOW, do NOT empty the source file
-            exit(1)
-        else:
-            LOGGER.info("Written %s failed records into file %s", str(len(FAILED_RECORDS)), failed_records_file)
+        profiler = cProfile.Profile()
+        atexit.register(write_profile, profiler)
+        profiler.enable()
 
-    # if succeeded writing down failed records (not exited with (1) above) - empty the source file,
-    # if "-d" flag was provided
-    if DELETE_FLAG:
-        try:
-            file = open(INPUTFILE, "w")
-            file.write("ADIF Export<eoh>\n")
-            file.close()
-        except IOError as e2:
-            LOGGER.error("Could not empty %s", INPUTFILE)
-            LOGGER.error("I/O error({0}): {1}".format(e2.errno, e2.strerror))
-            exit(1)
-        else:
-            LOGGER.info("Emptied the source file %s", INPUTFILE)
-
-    stats = "Run statistics - " + str(PROCESSED_RECORDS) + " records processed: "
-    name_plural = "records"
-    name_singular = "record"
-    if ADDED_RECORDS > 0:
-        records_name = name_plural
-        if ADDED_RECORDS == 1:
-            records_name = name_singular
-        stats = stats + str(ADDED_RECORDS) + " new " + records_name + " added. "
-    if IGNORED_RECORDS > 0:
-        records_name = name_plural
-        if IGNORED_RECORDS == 1:
-            records_name = name_singular
-        stats = stats + str(IGNORED_RECORDS) + " cached " + records_name + " ignored. "
-    if len(FAILED_RECORDS) > 0:
-        records_name = name_plural
-        if len(FAILED_RECORDS) == 1:
-            records_name = name_singular
-        stats = stats + str(len(FAILED_RECORDS)) + " " + records_name + " failed."
-
-    if CACHED_RECORDS > 0 or ADDED_RECORDS > 0 or len(FAILED_RECORDS) > 0:
-        LOGGER.info(stats)
-    exit(EXITCODE)
+    try:
+        with uploader:
+            if compact_flag:
+                log_to_file(logfile)
+                compact_cache(uploader, compact_hashes_only, compact_max_age)
+            else:
+                # check whether the default/specified inputfiles are present, a sync only needs them for merging
+                if not sync_flag or sync_merge:
+                    inputfiles[:] = expand_inputfiles(inputfiles)
+
+                run(uploader, inputfiles, logfile, sync_flag, sync_merge, watch_flag, watch_interval, write_idle_log,
+                    stats_json)
+    except QrzError as e:
+        LOGGER.error("%s", str(e))
+        EXITCODE = e.exitcode
+        exit(EXITCODE)
+
+    exit(uploader.exitcode)
 
 
 ########################################